@@ -0,0 +1,108 @@
+/*
+
+Keeps the start and end date inputs and the time range slider in step, in the browser. This was
+the set_date_range_from_slider server callback; the clamping is the same. Dates are YYYY-MM-DD
+and the slider is in seconds since 1970, both in UTC.
+
+*/
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    flux: {
+        set_date_range_from_slider: function (slide_values, in_start_date, in_end_date, initial_start, initial_end, time_bounds) {
+            const d_format = /^(\d{4})-(\d{1,2})-(\d{1,2})$/;
+
+            function parse_date(value) {
+                // Seconds for a YYYY-MM-DD string, or null when it is not a real date.
+                if (typeof value !== "string") {
+                    return null;
+                }
+                const parts = value.trim().match(d_format);
+                if (parts === null) {
+                    return null;
+                }
+                const year = Number(parts[1]);
+                const month = Number(parts[2]);
+                const day = Number(parts[3]);
+                const date = new Date(Date.UTC(year, month - 1, day));
+                if (date.getUTCFullYear() !== year || date.getUTCMonth() !== month - 1 || date.getUTCDate() !== day) {
+                    return null;
+                }
+                return date.getTime() / 1000;
+            }
+
+            function format_date(seconds) {
+                const date = new Date(seconds * 1000);
+                const month = String(date.getUTCMonth() + 1).padStart(2, "0");
+                const day = String(date.getUTCDate()).padStart(2, "0");
+                return date.getUTCFullYear() + "-" + month + "-" + day;
+            }
+
+            const range_min = time_bounds[0];
+            const range_max = time_bounds[1];
+            const triggered = window.dash_clientside.callback_context.triggered.map(t => t.prop_id.split(".")[0]);
+            const trigger_id = triggered[0];
+
+            let start_seconds;
+            let end_seconds;
+            let start_output;
+            let end_output;
+
+            if (trigger_id === "initial-time-start" || trigger_id === "initial-time-end") {
+                start_output = initial_start;
+                end_output = initial_end;
+                start_seconds = parse_date(initial_start);
+                if (start_seconds === null) {
+                    start_seconds = range_min;
+                }
+                end_seconds = parse_date(initial_end);
+                if (end_seconds === null) {
+                    end_seconds = range_max;
+                }
+            } else {
+                if (slide_values === null || slide_values === undefined) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+
+                start_seconds = slide_values[0];
+                end_seconds = slide_values[1];
+
+                start_output = in_start_date;
+                end_output = in_end_date;
+
+                if (trigger_id === "start-date") {
+                    let parsed = parse_date(in_start_date);
+                    if (parsed === null) {
+                        parsed = start_seconds;
+                    }
+                    start_seconds = parsed;
+                    if (start_seconds < range_min) {
+                        start_seconds = range_min;
+                    } else if (start_seconds > range_max) {
+                        start_seconds = range_max;
+                    } else if (start_seconds > end_seconds) {
+                        start_seconds = end_seconds;
+                    }
+                    start_output = format_date(start_seconds);
+                } else if (trigger_id === "end-date") {
+                    let parsed = parse_date(in_end_date);
+                    if (parsed === null) {
+                        parsed = end_seconds;
+                    }
+                    end_seconds = parsed;
+                    if (end_seconds < range_min) {
+                        end_seconds = range_min;
+                    } else if (end_seconds > range_max) {
+                        end_seconds = range_max;
+                    } else if (end_seconds < start_seconds) {
+                        end_seconds = start_seconds;
+                    }
+                    end_output = format_date(end_seconds);
+                } else if (trigger_id === "time-range-slider") {
+                    start_output = format_date(slide_values[0]);
+                    end_output = format_date(slide_values[1]);
+                }
+            }
+
+            return [[start_seconds, end_seconds], start_output, end_output];
+        }
+    }
+});
@@ -0,0 +1,176 @@
+import os
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+import constants
+import refdata
+
+# The nobs_<SHORT_NAMES> tables hold one row per (dataset, site, month) with the number of
+# observations of each variable in that month. Rather than going to the database every time the
+# question or the date range changes, each worker process reads those tables once and keeps them
+# as a cube of cumulative counts (variable x site x month) per table. Any date range is then two
+# index lookups and a subtraction, and the and/or join is a reduction over the variable axis.
+
+# AVAILABILITY_SOURCE=sql skips the cube and lets Postgres do the sums and the and/or decision,
+# so only one row per qualifying site comes back over the wire.
+availability_source = os.environ.get("AVAILABILITY_SOURCE", "cube")
+
+_cube = None
+_cube_pid = None
+
+
+def nobs_table(short_names):
+    return f'nobs_{"_".join(short_names)}'
+
+
+def _read_nobs(table, short_names):
+    var_list = ",".join(['"' + short + '"' for short in short_names])
+    read_dtypes = {}
+    for short in short_names:
+        read_dtypes[short] = np.float64
+    with constants.postgres_engine.connect() as conn:
+        nobs = pd.read_sql(
+            f'SELECT {var_list},time,site_code FROM "{table}"',
+            con=conn,
+            dtype=read_dtypes,
+        )
+    # The counts come from ERDDAP orderByCount so the time is the first instant of the month.
+    nobs["month"] = (
+        pd.to_datetime(nobs["time"], utc=True)
+        .dt.tz_localize(None)
+        .values.astype("datetime64[M]")
+        .astype(np.int64)
+    )
+    nobs["site_code"] = nobs["site_code"].astype(str)
+    nobs[short_names] = nobs[short_names].fillna(0)
+    return nobs
+
+
+def load_cube(discovery):
+    frames = {}
+    searches = {}
+    for qid in discovery:
+        for search in discovery[qid]["search"]:
+            short_names = search["short_names"]
+            table = nobs_table(short_names)
+            if table not in frames:
+                frames[table] = _read_nobs(table, short_names)
+                searches[table] = short_names
+
+    first_month = min([f["month"].min() for f in frames.values() if f.shape[0] > 0], default=0)
+    last_month = max([f["month"].max() for f in frames.values() if f.shape[0] > 0], default=-1)
+    months = np.arange(first_month, last_month + 1).astype("datetime64[M]")
+
+    tables = {}
+    for table in frames:
+        nobs = frames[table]
+        short_names = searches[table]
+        site_codes = np.unique(nobs["site_code"].values)
+        site_idx = np.searchsorted(site_codes, nobs["site_code"].values)
+        # Shifted by one so that slot 0 of the cumulative sum is the empty sum.
+        month_idx = nobs["month"].values - first_month + 1
+        counts = np.zeros((len(short_names), site_codes.shape[0], months.shape[0] + 1))
+        for vix, short in enumerate(short_names):
+            np.add.at(counts[vix], (site_idx, month_idx), nobs[short].values)
+        tables[table] = {
+            "short_names": short_names,
+            "site_codes": site_codes,
+            "cumulative": np.cumsum(counts, axis=2),
+        }
+
+    return {
+        "month_starts": months.astype("datetime64[s]"),
+        "tables": tables,
+    }
+
+
+def get_cube(discovery):
+    global _cube, _cube_pid
+    # Loaded lazily so each gunicorn or celery worker reads its own copy after the fork, and
+    # reloaded when make_nobs_db stamps a new build.
+    version = refdata.build_version()
+    if _cube is None or _cube_pid != os.getpid() or _cube["version"] != version:
+        _cube = load_cube(discovery)
+        _cube["version"] = version
+        _cube_pid = os.getpid()
+    return _cube
+
+
+def month_slice(cube, start, end):
+    # Match the old SQL string comparison against the ERDDAP month stamps ('...T00:00:00Z'):
+    # a month counts when it begins at or after start and strictly before end.
+    month_starts = cube["month_starts"]
+    lo = 0
+    hi = month_starts.shape[0]
+    if start is not None:
+        lo = np.searchsorted(month_starts, np.datetime64(start, "s"), side="left")
+    if end is not None:
+        hi = np.searchsorted(month_starts, np.datetime64(end, "s"), side="left")
+    return lo, max(lo, hi)
+
+
+def sites_with_data(discovery, search, start, end):
+    # Returns the site codes that satisfy the search over [start, end) with the per variable sums.
+    cube = get_cube(discovery)
+    short_names = search["short_names"]
+    entry = cube["tables"].get(nobs_table(short_names))
+    if entry is None:
+        return pd.DataFrame(columns=["site_code"] + short_names)
+    lo, hi = month_slice(cube, start, end)
+    cumulative = entry["cumulative"]
+    sums = cumulative[:, :, hi] - cumulative[:, :, lo]
+    if search["join"] == "and":
+        has_data = (sums > 0).all(axis=0)
+    else:
+        has_data = sums.sum(axis=0) > 0
+    csum = pd.DataFrame(sums.T, columns=short_names)
+    csum.insert(0, "site_code", entry["site_codes"])
+    return csum.loc[has_data].reset_index(drop=True)
+
+
+def _quote(name):
+    # Table and column names cannot be bound parameters, they come from the discovery config.
+    if '"' in name:
+        raise ValueError(f"Unexpected identifier in discovery config: {name}")
+    return '"' + name + '"'
+
+
+def nobs_sum_query(search, start, end):
+    short_names = search["short_names"]
+    sums = ["COALESCE(SUM(" + _quote(short) + "), 0)" for short in short_names]
+    columns = [s + " AS " + _quote(short) for s, short in zip(sums, short_names)]
+    if search["join"] == "and":
+        having = " AND ".join([s + " > 0" for s in sums])
+    else:
+        having = "(" + " + ".join(sums) + ") > 0"
+    where = []
+    params = {}
+    # time is stored as the ERDDAP ISO string so the comparison is the same one the cube mimics.
+    if start is not None:
+        where.append("time >= :start")
+        params["start"] = start.isoformat()
+    if end is not None:
+        where.append("time <= :end")
+        params["end"] = end.isoformat()
+    query = "SELECT site_code, " + ", ".join(columns)
+    query = query + " FROM " + _quote(nobs_table(short_names))
+    if len(where) > 0:
+        query = query + " WHERE " + " AND ".join(where)
+    query = query + " GROUP BY site_code HAVING " + having + " ORDER BY site_code"
+    return text(query), params
+
+
+def sites_with_data_sql(search, start, end):
+    query, params = nobs_sum_query(search, start, end)
+    with constants.postgres_engine.connect() as conn:
+        csum = pd.read_sql(query, con=conn, params=params)
+    csum["site_code"] = csum["site_code"].astype(str)
+    return csum
+
+
+def find_sites_with_data(discovery, search, start, end):
+    if availability_source == "sql":
+        return sites_with_data_sql(search, start, end)
+    return sites_with_data(discovery, search, start, end)
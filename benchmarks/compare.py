@@ -0,0 +1,43 @@
+import json
+import sys
+
+# Lines up two results files from run.py, usually a baseline commit and a change:
+#
+#   python benchmarks/compare.py benchmarks/results/<before>.json benchmarks/results/<after>.json
+#
+# Ratios are after / before of the median latency and of the peak memory, so below 1 is better.
+
+
+def load(path):
+    with open(path) as results_stream:
+        return json.load(results_stream)
+
+
+def compare(before, after):
+    lines = [f"before {before['commit'][:10]}  after {after['commit'][:10]}"]
+    if before.get("series") != after.get("series"):
+        lines.append("warning: the runs replayed different ERDDAP recordings, the plot cases are not comparable")
+    for scale in after["scales"]:
+        if scale not in before["scales"]:
+            continue
+        lines.append(f"\n{scale}x")
+        old_cases = before["scales"][scale]["cases"]
+        for name, new in after["scales"][scale]["cases"].items():
+            old = old_cases.get(name)
+            if old is None:
+                lines.append(f"  {name:70s} new {new['p50'] * 1000:9.1f} ms")
+                continue
+            time_ratio = new["p50"] / old["p50"] if old["p50"] > 0 else float("nan")
+            memory_ratio = new["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] > 0 else float("nan")
+            lines.append(
+                f"  {name:70s} {old['p50'] * 1000:9.1f} -> {new['p50'] * 1000:9.1f} ms  x{time_ratio:5.2f}"
+                f"  peak x{memory_ratio:5.2f}"
+            )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python benchmarks/compare.py BEFORE.json AFTER.json")
+        sys.exit(2)
+    print(compare(load(sys.argv[1]), load(sys.argv[2])))
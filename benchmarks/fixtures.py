@@ -0,0 +1,342 @@
+import argparse
+import functools
+import os
+import re
+import sys
+import urllib.parse
+import urllib.request
+import zlib
+
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import erddap_cache
+import seed
+
+# ERDDAP time series for the benchmarks, read from CSV files instead of from data.pmel.noaa.gov.
+# A fixture is the raw tabledap .csv response (names row, units row) for one site of one data set,
+# in fixtures/<did>/<site_code>.csv. The repository does not ship any: record them on a machine
+# that can reach the server, and commit them, with
+#
+#   python benchmarks/fixtures.py record-set
+#
+# which saves PAPA, KEO and, for every other data set of the app, the site with the most
+# observations (usually one with several deployments). One site is recorded with
+#
+#   python benchmarks/fixtures.py record https://data.pmel.noaa.gov/pmel/erddap/tabledap/ocs_papa_flux PAPA
+#
+# A site without a recording gets the recording of another site of the same data set, so the
+# extra sites seed.py adds at larger scales replay real series too. Only a data set without any
+# recording gets a synthetic hourly series seeded from its name; run.py lists those data sets in
+# its results, since their timings say nothing about real response shapes (irregular sampling,
+# runs of missing values, deployment gaps). The sites of a data set are the recorded ones plus the
+# synthetic sites seed.py puts in the database at BENCH_SCALE.
+#
+# query() answers the subset of tabledap the app and nobs_db use: a variable list, constraints on
+# any variable (=, !=, <, <=, >, >=, =~), distinct(), orderBy() and orderByCount() with time/1month
+# style intervals. read_erddap_csv() replays in process; mock_erddap.py serves the same over HTTP.
+
+fixture_dir = os.environ.get("BENCH_FIXTURE_DIR", os.path.join(here, "fixtures"))
+site_scale = int(os.environ.get("BENCH_SCALE", 1))
+synthetic_start = "1990-01-01"
+synthetic_end = "2025-01-01"
+synthetic_freq = "1h"
+site_variables = ["site_code", "wmo_platform_code", "latitude", "longitude"]
+# Sites recorded by record-set regardless of their size.
+pinned_sites = {"ocs_papa_flux": "PAPA", "ocs_keo_flux": "KEO"}
+
+
+class NoMatchingRows(Exception):
+    # ERDDAP answers 404 when the constraints leave nothing.
+    pass
+
+
+def fixture_path(did, site_code):
+    return os.path.join(fixture_dir, did, site_code + ".csv")
+
+
+def recorded_sites(did):
+    if not os.path.isdir(os.path.join(fixture_dir, did)):
+        return []
+    return sorted([f[:-4] for f in os.listdir(os.path.join(fixture_dir, did)) if f.endswith(".csv")])
+
+
+def series_sources(dids):
+    # For the results file: the recorded sites of each data set, or "synthetic".
+    return {did: recorded_sites(did) or "synthetic" for did in dids}
+
+
+def synthetic_series(did, site_code, variables):
+    rng = np.random.default_rng(zlib.crc32((did + "/" + site_code).encode()))
+    times = pd.date_range(synthetic_start, synthetic_end, freq=synthetic_freq, inclusive="left", unit="s")
+    # A deployment of 5 to 30 years with a few multi-week gaps.
+    years = int(rng.integers(5, 31))
+    first = int(rng.integers(0, max(1, times.shape[0] - years * 8766)))
+    times = times[first:first + years * 8766]
+    keep = np.ones(times.shape[0], dtype=bool)
+    for gap in rng.integers(0, times.shape[0], size=years // 3):
+        keep[gap:gap + int(rng.integers(24 * 7, 24 * 60))] = False
+    times = times[keep]
+    phase = np.arange(times.shape[0]) * 2 * np.pi / 8766
+    df = pd.DataFrame({"_time": times.tz_localize("UTC")})
+    for v in variables:
+        values = 50 * np.sin(phase + rng.uniform(0, 2 * np.pi)) + rng.normal(0, 10, times.shape[0])
+        values[rng.random(times.shape[0]) < 0.01] = np.nan
+        df[v] = values
+    return df
+
+
+@functools.lru_cache(maxsize=1)
+def synthetic_sites():
+    # The same sites seed.seed(site_scale) writes to the locations table.
+    discovery_json, platform_json = seed.load_config()
+    rng = np.random.default_rng(site_scale)
+    return seed.make_sites(seed.dataset_urls(discovery_json, platform_json), site_scale, rng)
+
+
+@functools.lru_cache(maxsize=64)
+def dataset_sites(did):
+    sites = synthetic_sites()
+    sites = sites.loc[sites["family"] == seed.family(did), site_variables]
+    recorded = []
+    for site_code in recorded_sites(did):
+        df = pd.read_csv(fixture_path(did, site_code), skiprows=[1], nrows=1)
+        recorded.append({v: df[v].values[0] if v in df.columns else np.nan for v in site_variables})
+        recorded[-1]["site_code"] = site_code
+    if len(recorded) > 0:
+        sites = pd.concat([pd.DataFrame(recorded), sites], ignore_index=True)
+    sites["site_code"] = sites["site_code"].astype(str)
+    sites["wmo_platform_code"] = sites["wmo_platform_code"].astype(str)
+    return sites.reset_index(drop=True)
+
+
+@functools.lru_cache(maxsize=256)
+def load_fixture(did, site_code, variables):
+    # One site's series with its time parsed into _time; the ERDDAP time strings are only made
+    # for the rows that are sent.
+    sites = recorded_sites(did)
+    if site_code in sites:
+        df = pd.read_csv(fixture_path(did, site_code), skiprows=[1])
+    elif len(sites) > 0:
+        df = pd.read_csv(fixture_path(did, sites[0]), skiprows=[1])
+    else:
+        df = synthetic_series(did, site_code, list(variables))
+    if "_time" not in df.columns:
+        df["_time"] = pd.to_datetime(df["time"], utc=True)
+    df = df.drop(columns=[c for c in site_variables + ["time"] if c in df.columns])
+    for v in variables:
+        if v not in df.columns:
+            df[v] = np.nan
+    return df
+
+
+def parse_query(query_string):
+    # "<variables>&<constraint>&...&function(...)" into its parts, unquoted.
+    parts = urllib.parse.unquote(query_string).split("&")
+    variables = [v for v in parts[0].split(",") if v != ""]
+    constraints = []
+    functions = []
+    for part in parts[1:]:
+        if part == "":
+            continue
+        function = re.match(r'^(\w+)\("?([^"]*)"?\)$', part)
+        if function is not None:
+            functions.append((function.group(1), [a.strip() for a in function.group(2).split(",") if a.strip() != ""]))
+        else:
+            constraints.append(part)
+    return variables, constraints, functions
+
+
+def split_constraint(constraint):
+    for op in (">=", "<=", "!=", "=~", ">", "<", "="):
+        if op in constraint:
+            name, value = constraint.split(op, 1)
+            return name, op, value.strip('"')
+    raise ValueError(f"Unable to parse the constraint {constraint}")
+
+
+def apply_constraints(df, constraints):
+    for constraint in constraints:
+        name, op, value = split_constraint(constraint)
+        if name == "time":
+            column = df["_time"]
+            value = pd.Timestamp(value)
+            value = value.tz_localize("UTC") if value.tzinfo is None else value
+        else:
+            column = df[name]
+            if column.dtype.kind in "fi":
+                value = float(value)
+            else:
+                column = column.astype(str)
+        if op == ">=":
+            df = df.loc[column >= value]
+        elif op == "<=":
+            df = df.loc[column <= value]
+        elif op == ">":
+            df = df.loc[column > value]
+        elif op == "<":
+            df = df.loc[column < value]
+        elif op == "!=":
+            df = df.loc[column != value]
+        elif op == "=~":
+            df = df.loc[column.str.fullmatch(value)]
+        else:
+            df = df.loc[column == value]
+    return df
+
+
+def floor_time(times, interval):
+    # The /1month of orderByCount("...,time/1month").
+    number, unit = re.match(r"^(\d*)\s*([a-z]+?)s?$", interval).groups()
+    if number not in ("", "1"):
+        raise ValueError(f"Only single unit time intervals are supported, not {interval}")
+    naive = times.dt.tz_localize(None)
+    if unit == "month":
+        return naive.dt.to_period("M").dt.to_timestamp().dt.tz_localize("UTC")
+    if unit == "year":
+        return naive.dt.to_period("Y").dt.to_timestamp().dt.tz_localize("UTC")
+    return times.dt.floor({"day": "D", "hour": "h", "minute": "min", "second": "s"}[unit])
+
+
+def order_by_count(df, variables, names):
+    # Groups on names and counts the non-missing values of every other requested variable.
+    keys = []
+    for name in names:
+        column, _, interval = name.partition("/")
+        key = "_time" if column == "time" else column
+        if interval != "":
+            df = df.assign(**{key: floor_time(df[key], interval)})
+        keys.append(key)
+    counted = [("_time" if v == "time" else v) for v in variables if ("_time" if v == "time" else v) not in keys]
+    df = df.groupby(keys, sort=True)[counted].count().reset_index()
+    if "_time" in counted:
+        # A count of time is a column of numbers named time, not a time to format.
+        df = df.rename(columns={"_time": "time"})
+    return df
+
+
+def series_rows(did, sites, variables, constraints, functions):
+    measured = tuple(v for v in variables if v not in site_variables + ["time"])
+    count = [args for name, args in functions if name == "orderByCount"]
+    frames = []
+    for site in sites.to_dict(orient="records"):
+        df = apply_constraints(load_fixture(did, site["site_code"], measured), constraints)
+        if df.shape[0] == 0:
+            continue
+        df = df.assign(**site)
+        if len(count) > 0:
+            # Counted one site at a time so the whole data set is never in memory at once.
+            df = order_by_count(df, variables, count[0])
+        frames.append(df)
+    if len(frames) == 0:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+def query(did, query_string):
+    variables, constraints, functions = parse_query(query_string)
+    on_site = [c for c in constraints if split_constraint(c)[0] in site_variables]
+    on_series = [c for c in constraints if split_constraint(c)[0] not in site_variables]
+    sites = apply_constraints(dataset_sites(did), on_site)
+    if all(v in site_variables for v in variables) and len(on_series) == 0:
+        df = sites
+    else:
+        df = series_rows(did, sites, variables, on_series, functions)
+    if df is None or df.shape[0] == 0:
+        raise NoMatchingRows(did)
+    if "_time" in df.columns and "time" in variables:
+        seconds = df["_time"].dt.tz_localize(None).values.astype("datetime64[s]")
+        df = df.assign(time=np.char.add(np.datetime_as_string(seconds, unit="s"), "Z"))
+    df = df[variables]
+    for name, args in functions:
+        if name == "distinct":
+            df = df.drop_duplicates().sort_values(variables)
+        elif name == "orderBy":
+            df = df.sort_values(args)
+    return df.reset_index(drop=True)
+
+
+def to_csv(df):
+    # ERDDAP's .csv: a row of names, a row of units, then the data.
+    units = {"time": "UTC", "latitude": "degrees_north", "longitude": "degrees_east"}
+    header = ",".join(df.columns) + "\n" + ",".join([units.get(c, "") for c in df.columns]) + "\n"
+    return header + df.to_csv(index=False, header=False, na_rep="NaN")
+
+
+def read_erddap_csv(url):
+    # Stands in for erddap_cache.read_erddap_csv: the frame pd.read_csv would make of the
+    # response, or None where ERDDAP would answer 404 for no matching rows.
+    path, _, query_string = url.partition("?")
+    try:
+        return query(path[path.rindex("/") + 1:path.rindex(".")], query_string)
+    except NoMatchingRows:
+        return None
+
+
+def record(url, site_code, variables=None, start=synthetic_start, end=synthetic_end):
+    did = url[url.rindex("/") + 1:]
+    if variables is None:
+        discovery = pd.read_csv(url + ".csv?site_code&distinct()", skiprows=[1])
+        if site_code not in discovery["site_code"].astype(str).values:
+            raise ValueError(f"{site_code} is not in {did}")
+        info = pd.read_csv(url.replace("/tabledap/", "/info/") + "/index.csv")
+        variables = list(info.loc[info["Row Type"] == "variable", "Variable Name"])
+        variables = [v for v in variables if v not in ["time", "depth"] + site_variables]
+    request = erddap_cache.series_url(url, site_code, variables, erddap_cache.to_ns(start), erddap_cache.to_ns(end))
+    # Keep the position so the mock server can answer the locations query for the site.
+    request = request.replace(",site_code,time", "," + ",".join(site_variables) + ",time")
+    os.makedirs(os.path.join(fixture_dir, did), exist_ok=True)
+    with urllib.request.urlopen(request, timeout=erddap_cache.fetch_timeout) as response:
+        with open(fixture_path(did, site_code), "wb") as fixture_stream:
+            fixture_stream.write(response.read())
+    return fixture_path(did, site_code)
+
+
+def busiest_site(url):
+    # The site with the most time steps in the data set.
+    counts = pd.read_csv(url + '.csv?site_code,time&orderByCount("site_code")', skiprows=[1])
+    return str(counts.sort_values(["time", "site_code"], ascending=[False, True])["site_code"].iloc[0])
+
+
+def record_set(start=synthetic_start, end=synthetic_end):
+    # One site of every data set the app reads, with the variables the discovery questions plot.
+    discovery_json, platform_json = seed.load_config()
+    variables = seed.variables_by_did(discovery_json)
+    written = []
+    for url in seed.dataset_urls(discovery_json, platform_json):
+        did = seed.did_of(url)
+        try:
+            site_code = pinned_sites.get(did) or busiest_site(url)
+            written.append(record(url, site_code, variables.get(did), start, end))
+        except Exception as e:
+            print(f"Unable to record {did}: {e}")
+        else:
+            print("Wrote", written[-1])
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record ERDDAP responses for the benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="save one site of a tabledap data set as a fixture")
+    record_parser.add_argument("url", help="tabledap data set URL, without .csv")
+    record_parser.add_argument("site_code")
+    record_parser.add_argument("--variables", help="comma separated, default every data variable")
+    record_parser.add_argument("--start", default=synthetic_start)
+    record_parser.add_argument("--end", default=synthetic_end)
+    set_parser = commands.add_parser("record-set", help="save one site of every data set the app reads")
+    set_parser.add_argument("--start", default=synthetic_start)
+    set_parser.add_argument("--end", default=synthetic_end)
+    args = parser.parse_args(argv)
+    if args.command == "record-set":
+        record_set(args.start, args.end)
+        return
+    variables = None if args.variables is None else args.variables.split(",")
+    print("Wrote", record(args.url, args.site_code, variables, args.start, args.end))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+import argparse
+import base64
+import datetime
+import json
+import math
+import os
+import random
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import numpy as np
+import redis
+import requests
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, here)
+
+import run
+
+# Simulated users against a running deployment, through the same /_dash-update-component requests
+# the browser makes, to find where the gunicorn workers or the Celery worker saturate. Each user
+# loops over one visit:
+#
+#   load the page (/, /_dash-layout) and run process_query
+#   pick a question        -> update_platform_state, make_location_map
+#   click a platform       -> update_selected_platform, make_location_map, stamp_plot_request,
+#                             plot_from_selected_platform
+#   move the slider        -> update_platform_state, make_location_map, stamp_plot_request,
+#                             plot_from_selected_platform
+#
+# waiting --think seconds between the steps. The plot is a background callback, so its latency is
+# from the first request to the result, polling with cacheKey/job like the renderer. The number of
+# users goes up in steps; for each step the throughput, p50/p99 per callback and the depth of the
+# Celery queue (LLEN of the broker list) are reported and written to benchmarks/results/.
+#
+# With the stack running already (Redis, Postgres filled by seed.py, the mock ERDDAP, gunicorn and
+# the Celery worker with ERDDAP_URL_MAP pointing at the mock):
+#
+#   python benchmarks/loadtest.py --url http://127.0.0.1:8000 --users 1 2 4 8 16 32 --duration 60
+#
+# or let it start the mock ERDDAP and the web and worker-default entries of the Procfile:
+#
+#   DATABASE_URL=postgresql://... python benchmarks/seed.py 10
+#   DATABASE_URL=postgresql://... python benchmarks/loadtest.py --launch --scale 10
+
+default_users = [1, 2, 4, 8, 16, 32]
+procfile_entries = ["web", "worker-default"]
+ready_seconds = 180
+plot_timeout = 300
+queue_sample_seconds = 0.5
+
+
+def find_component(layout, component_id):
+    # Depth first through the children of the /_dash-layout JSON.
+    if isinstance(layout, list):
+        for child in layout:
+            found = find_component(child, component_id)
+            if found is not None:
+                return found
+        return None
+    if not isinstance(layout, dict) or "props" not in layout:
+        return None
+    if layout["props"].get("id") == component_id:
+        return layout
+    return find_component(layout["props"].get("children"), component_id)
+
+
+def plotly_array(value):
+    # Plotly sends numeric arrays as base64 typed arrays.
+    if isinstance(value, dict) and "bdata" in value:
+        return np.frombuffer(base64.b64decode(value["bdata"]), dtype=value["dtype"]).tolist()
+    return value
+
+
+def output_spec(output):
+    # "..a.b...c.d.." for several outputs, "a.b" for one.
+    if output.startswith(".."):
+        return [output_spec(part) for part in output[2:-2].split("...")]
+    component_id, _, prop = output.rpartition(".")
+    return {"id": component_id, "property": prop}
+
+
+class Site:
+    # What every user of the deployment shares: the callback specs and the page defaults.
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        response = requests.get(self.url + "/_dash-dependencies", timeout=60)
+        response.raise_for_status()
+        self.callbacks = {}
+        for spec in response.json():
+            if spec.get("clientside_function") is None:
+                self.callbacks[spec["output"]] = spec
+        response = requests.get(self.url + "/_dash-layout", timeout=60)
+        response.raise_for_status()
+        layout = response.json()
+        self.start = find_component(layout, "start-date")["props"]["value"]
+        self.end = find_component(layout, "end-date")["props"]["value"]
+        self.questions = [o["value"] for o in find_component(layout, "radio-items")["props"]["options"]]
+
+    def callback(self, output):
+        # The spec whose outputs include this id.property.
+        for key, spec in self.callbacks.items():
+            if re.search(r"(^|\.\.)" + re.escape(output) + r"(\.\.|$)", key):
+                return spec
+        raise KeyError(output)
+
+
+class User:
+    def __init__(self, site, record, think, rng, stop):
+        self.site = site
+        self.record = record
+        self.think = think
+        self.rng = rng
+        self.stop = stop
+        self.session = requests.Session()
+        self.session.headers["Referer"] = site.url + "/"
+        self.end_id = None
+        self.locations = []
+        self.values = {}
+
+    def pause(self):
+        if self.think > 0:
+            self.stop.wait(self.rng.uniform(0.5, 1.5) * self.think)
+
+    def timed(self, kind, call):
+        start = timeit.default_timer()
+        try:
+            result = call()
+        except Exception as e:
+            self.record(kind, timeit.default_timer() - start, type(e).__name__)
+            raise
+        self.record(kind, timeit.default_timer() - start, None)
+        return result
+
+    def load_page(self):
+        response = self.session.get(self.site.url + "/", timeout=60)
+        response.raise_for_status()
+        config = re.search(r'<script id="_dash-config" type="application/json">(.*?)</script>', response.text, re.S)
+        self.end_id = json.loads(config.group(1)).get("end_id") if config is not None else None
+        response = self.session.get(self.site.url + "/_dash-layout", timeout=60)
+        response.raise_for_status()
+        # Every page load has its own session id, which numbers its plot requests.
+        session_id = find_component(response.json(), "session-id")
+        self.values["session-id.data"] = None if session_id is None else session_id["props"].get("data")
+
+    def post(self, spec, changed, params=None, body=None):
+        if body is None:
+            body = {
+                "output": spec["output"],
+                "outputs": output_spec(spec["output"]),
+                "inputs": [dict(i, value=self.values.get(i["id"] + "." + i["property"])) for i in spec["inputs"]],
+                "state": [dict(s, value=self.values.get(s["id"] + "." + s["property"])) for s in spec["state"]],
+                "changedPropIds": changed,
+            }
+        params = dict(params or {})
+        if self.end_id is not None:
+            params["endId"] = self.end_id
+        response = self.session.post(self.site.url + "/_dash-update-component", params=params, json=body, timeout=120)
+        if response.status_code not in (200, 204):
+            raise requests.HTTPError(f"{response.status_code} from {spec['output']}", response=response)
+        return body, None if response.status_code == 204 else response.json()
+
+    def keep(self, result):
+        # The outputs go back into the page, as the renderer would set them.
+        if result is None or "response" not in result:
+            return
+        for component_id, props in result["response"].items():
+            for prop, value in props.items():
+                self.values[component_id + "." + prop] = value
+
+    def update(self, output, changed):
+        _, result = self.post(self.site.callback(output), changed)
+        self.keep(result)
+        return result
+
+    def update_map(self, changed):
+        # The positions only come in the full figure, the first one of a page; later ones are patches.
+        result = self.update("location-map.figure", [changed])
+        figure = (result or {}).get("response", {}).get("location-map", {}).get("figure", {})
+        if "data" in figure:
+            points = figure["data"][0]
+            self.locations = [
+                {"site_code": site, "latitude": lat, "longitude": lon}
+                for site, lat, lon in zip(
+                    plotly_array(points["customdata"]), plotly_array(points["lat"]), plotly_array(points["lon"])
+                )
+            ]
+        return result
+
+    def background(self, output, changed):
+        spec = self.site.callback(output)
+        interval = (spec.get("background") or spec.get("long") or {}).get("interval", 1000) / 1000
+        body, result = self.post(spec, changed)
+        deadline = timeit.default_timer() + plot_timeout
+        handles = {}
+        while result is not None and "response" not in result:
+            if "cacheKey" in result:
+                handles = {"cacheKey": result["cacheKey"], "job": result["job"]}
+                # The renderer sends the inputs again without their values while it polls.
+                body = dict(
+                    body,
+                    inputs=[dict(i, value=None) for i in body["inputs"]],
+                    state=[dict(s, value=None) for s in body["state"]],
+                )
+            if timeit.default_timer() > deadline:
+                raise TimeoutError(f"No result from {spec['output']} after {plot_timeout} seconds")
+            time.sleep(interval)
+            _, result = self.post(spec, changed, params=handles, body=body)
+        self.keep(result)
+        return result
+
+    def set_dates(self, start, end):
+        self.values["start-date.value"] = start
+        self.values["end-date.value"] = end
+
+    def pick_question(self):
+        self.values["radio-items.value"] = self.rng.choice(self.site.questions)
+        self.timed("update_platform_state", lambda: self.update("active-platforms.data", ["radio-items.value"]))
+        self.timed("make_location_map", lambda: self.update_map("active-platforms.data"))
+
+    def click_platform(self):
+        active = (self.values.get("active-platforms.data") or {}).get("rows", [])
+        rows = active if len(active) > 0 else range(len(self.locations))
+        location = self.locations[self.rng.choice(list(rows))]
+        self.values["location-map.clickData"] = {
+            "points": [{"customdata": location["site_code"], "lat": location["latitude"], "lon": location["longitude"]}]
+        }
+        self.timed("update_selected_platform", lambda: self.update("selected-platform.data", ["location-map.clickData"]))
+        self.timed("make_location_map", lambda: self.update_map("selected-platform.data"))
+        self.plot("selected-platform.data")
+
+    def move_slider(self):
+        # assets/date_range.js turns the slider into dates in the browser; only the dates reach the server.
+        first = datetime.date.fromisoformat(str(self.site.start)[:10])
+        last = datetime.date.fromisoformat(str(self.site.end)[:10])
+        days = (last - first).days
+        start = first + datetime.timedelta(days=self.rng.randint(0, max(0, days - 365)))
+        end = start + datetime.timedelta(days=self.rng.randint(365, max(365, (last - start).days)))
+        self.set_dates(start.isoformat(), min(end, last).isoformat())
+        self.timed("update_platform_state", lambda: self.update("active-platforms.data", ["start-date.value"]))
+        self.timed("make_location_map", lambda: self.update_map("active-platforms.data"))
+        self.plot("start-date.value")
+
+    def plot(self, changed):
+        self.timed("stamp_plot_request", lambda: self.update("plot-request.data", [changed]))
+        self.timed("plot_from_selected_platform", lambda: self.background("plot-graph.figure", ["plot-request.data"]))
+
+    def open_page(self):
+        self.timed("page_load", self.load_page)
+        self.timed("process_query", lambda: self.update("initial-time-start.data", ["data-div.n_clicks"]))
+
+    def visit(self):
+        # False when the step ended part way through.
+        self.values = {}
+        self.set_dates(self.site.start, self.site.end)
+        for action in (self.open_page, self.pick_question, self.click_platform, self.move_slider):
+            if self.stop.is_set():
+                return False
+            action()
+            self.pause()
+        return True
+
+
+def percentile(values, fraction):
+    # Nearest rank.
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(samples, seconds):
+    kinds = {}
+    for kind, elapsed, error in samples:
+        kinds.setdefault(kind, {"seconds": [], "errors": 0})
+        if error is None:
+            kinds[kind]["seconds"].append(elapsed)
+        else:
+            kinds[kind]["errors"] += 1
+    summary = {}
+    for kind, found in kinds.items():
+        done = found["seconds"]
+        summary[kind] = {
+            "n": len(done),
+            "errors": found["errors"],
+            "per_second": len(done) / seconds,
+            "p50": percentile(done, 0.5) if len(done) > 0 else None,
+            "p99": percentile(done, 0.99) if len(done) > 0 else None,
+            "max": max(done) if len(done) > 0 else None,
+        }
+    return summary
+
+
+def sample_queue(broker, queue, stop, depths):
+    failed = False
+    while not stop.is_set():
+        try:
+            depths.append(broker.llen(queue))
+        except redis.RedisError as e:
+            if not failed:
+                print(f"Unable to read the depth of the {queue} queue: {e}")
+                failed = True
+        stop.wait(queue_sample_seconds)
+
+
+def run_step(site, users, duration, think, broker, queue, seed_value):
+    samples = []
+    lock = threading.Lock()
+    stop = threading.Event()
+    depths = []
+
+    def record(kind, elapsed, error):
+        with lock:
+            samples.append((kind, elapsed, error))
+
+    def loop(n):
+        user = User(site, record, think, random.Random(seed_value * 1000 + n), stop)
+        while not stop.is_set():
+            start = timeit.default_timer()
+            try:
+                finished = user.visit()
+            except Exception as e:
+                # The request that failed is recorded too; start over with a fresh page like a user
+                # hitting reload.
+                record("visit", timeit.default_timer() - start, type(e).__name__)
+                continue
+            if finished:
+                record("visit", timeit.default_timer() - start, None)
+
+    sampler = threading.Thread(target=sample_queue, args=(broker, queue, stop, depths), daemon=True)
+    threads = [threading.Thread(target=loop, args=(n,), daemon=True) for n in range(users)]
+    start = timeit.default_timer()
+    sampler.start()
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    # Let the visits in progress finish so their requests are counted, but not forever.
+    for thread in threads:
+        thread.join(timeout=plot_timeout)
+    seconds = timeit.default_timer() - start
+    with lock:
+        finished = list(samples)
+    requests_done = [s for s in finished if s[0] not in ("visit", "page_load") and s[2] is None]
+    return {
+        "users": users,
+        "seconds": seconds,
+        "requests_per_second": len(requests_done) / seconds,
+        "visits_per_minute": 60 * len([s for s in finished if s[0] == "visit" and s[2] is None]) / seconds,
+        "errors": len([s for s in finished if s[2] is not None and s[0] != "visit"]),
+        "queue_depth": {
+            "mean": sum(depths) / len(depths) if len(depths) > 0 else None,
+            "max": max(depths) if len(depths) > 0 else None,
+        },
+        "callbacks": summarize(finished, seconds),
+    }
+
+
+def print_step(step):
+    queue = step["queue_depth"]
+    print(
+        f"\n{step['users']} users: {step['requests_per_second']:.1f} callbacks/s, {step['visits_per_minute']:.1f} visits/min, "
+        f"{step['errors']} errors, queue depth mean {queue['mean'] if queue['mean'] is None else round(queue['mean'], 1)} max {queue['max']}"
+    )
+    for kind, result in step["callbacks"].items():
+        if result["n"] == 0:
+            print(f"  {kind:30s} n {0:6d}  errors {result['errors']:5d}")
+            continue
+        print(
+            f"  {kind:30s} n {result['n']:6d}  errors {result['errors']:5d}  p50 {result['p50'] * 1000:9.1f} ms"
+            f"  p99 {result['p99'] * 1000:9.1f} ms  max {result['max'] * 1000:9.1f} ms"
+        )
+
+
+def procfile_commands():
+    commands = {}
+    with open(os.path.join(root, "Procfile")) as procfile_stream:
+        for line in procfile_stream:
+            name, _, command = line.partition(":")
+            if command.strip() != "":
+                commands[name.strip()] = command.strip()
+    return commands
+
+
+def launch(scale, mock_port, log_dir):
+    # The mock ERDDAP plus the Procfile entries, each in its own process group so it can be stopped
+    # with its children (the gunicorn and celery workers).
+    env = dict(os.environ)
+    env["ERDDAP_URL_MAP"] = f"https://data.pmel.noaa.gov/pmel/erddap=http://127.0.0.1:{mock_port}/erddap"
+    commands = {"mock-erddap": f"{shlex.quote(sys.executable)} benchmarks/mock_erddap.py --port {mock_port} --scale {scale}"}
+    found = procfile_commands()
+    for name in procfile_entries:
+        commands[name] = found[name]
+    processes = []
+    for name, command in commands.items():
+        log = open(os.path.join(log_dir, name + ".log"), "w")
+        processes.append(subprocess.Popen(command, shell=True, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True))
+        print(f"Started {name}: {command} (log in {log.name})")
+    return processes
+
+
+def stop_processes(processes):
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def wait_until_ready(url, processes):
+    deadline = timeit.default_timer() + ready_seconds
+    while timeit.default_timer() < deadline:
+        if any(process.poll() is not None for process in processes):
+            raise RuntimeError("A process exited before the app was up, see its log")
+        try:
+            if requests.get(url + "/_dash-dependencies", timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    raise RuntimeError(f"{url} did not answer within {ready_seconds} seconds")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the dashboard with simulated users and report where it saturates.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="where gunicorn listens")
+    parser.add_argument("--users", type=int, nargs="+", default=default_users, help="simulated users for each step")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per step")
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds a user waits between steps")
+    parser.add_argument("--redis-url", default=os.environ.get("REDIS_URL", "redis://127.0.0.1:6379"), help="the Celery broker")
+    parser.add_argument("--queue", default="celery", help="the Celery queue to watch")
+    parser.add_argument("--launch", action="store_true", help="start the mock ERDDAP and the Procfile web and worker-default entries")
+    parser.add_argument("--scale", type=int, default=1, help="with --launch, the scale seed.py filled the database at")
+    parser.add_argument("--mock-port", type=int, default=8090)
+    parser.add_argument("--output", default=os.path.join(here, "results"), help="directory for the results file")
+    args = parser.parse_args(argv)
+
+    processes = []
+    if args.launch:
+        log_dir = tempfile.mkdtemp(prefix="flux-loadtest-")
+        processes = launch(args.scale, args.mock_port, log_dir)
+    try:
+        if args.launch:
+            wait_until_ready(args.url.rstrip("/"), processes)
+        site = Site(args.url)
+        broker = redis.Redis.from_url(args.redis_url, socket_timeout=5)
+        commit, dirty = run.git_commit()
+        results = {
+            "commit": commit,
+            "dirty": dirty,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "url": site.url,
+            "duration": args.duration,
+            "think": args.think,
+            "steps": [],
+        }
+        for n, users in enumerate(args.users):
+            step = run_step(site, users, args.duration, args.think, broker, args.queue, n)
+            results["steps"].append(step)
+            print_step(step)
+    finally:
+        stop_processes(processes)
+
+    os.makedirs(args.output, exist_ok=True)
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(args.output, f"loadtest-{stamp}-{commit[:10]}{'-dirty' if dirty else ''}.json")
+    with open(path, "w") as results_stream:
+        json.dump(results, results_stream, indent=2)
+    print("\nWrote", path)
+
+
+if __name__ == "__main__":
+    main()
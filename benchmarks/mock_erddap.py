@@ -0,0 +1,158 @@
+import argparse
+import functools
+import json
+import os
+import random
+import sys
+import time
+
+import flask
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+import fixtures
+import seed
+
+# A stand-in for data.pmel.noaa.gov/pmel/erddap serving the benchmark fixtures over HTTP, so the
+# app, nobs_db and the load test can run without the real server. It answers
+#
+#   /erddap/tabledap/<did>.csv?...        through fixtures.query (distinct, orderBy, orderByCount,
+#                                         constraints on time, site_code and the rest)
+#   /erddap/info/<did>/index.csv|.json    title, time coverage, variables and units
+#
+# and can be made slow or unreliable to see how the app copes. Point the app at it with
+#
+#   python benchmarks/mock_erddap.py --port 8090 --latency 0.2 --error-rate 0.05
+#   ERDDAP_URL_MAP=https://data.pmel.noaa.gov/pmel/erddap=http://127.0.0.1:8090/erddap python app.py
+#
+# or run it under gunicorn (benchmarks/mock_erddap:server) with the MOCK_ERDDAP_* variables.
+
+settings = {
+    "latency": float(os.environ.get("MOCK_ERDDAP_LATENCY", 0.0)),
+    "jitter": float(os.environ.get("MOCK_ERDDAP_JITTER", 0.0)),
+    "error_rate": float(os.environ.get("MOCK_ERDDAP_ERROR_RATE", 0.0)),
+    "error_status": int(os.environ.get("MOCK_ERDDAP_ERROR_STATUS", 500)),
+}
+
+server = flask.Flask(__name__)
+
+
+@functools.lru_cache(maxsize=1)
+def known_datasets():
+    discovery_json, platform_json = seed.load_config()
+    dids = [seed.did_of(url) for url in seed.dataset_urls(discovery_json, platform_json)]
+    if os.path.isdir(fixtures.fixture_dir):
+        dids = dids + [did for did in sorted(os.listdir(fixtures.fixture_dir)) if did not in dids]
+    return dids
+
+
+def erddap_error(status, message):
+    # The plain text error body ERDDAP sends with the status.
+    body = "Error {\n    code=" + str(status) + ';\n    message="' + message + '";\n}\n'
+    return flask.Response(body, status=status, mimetype="text/plain")
+
+
+@server.before_request
+def inject_trouble():
+    delay = settings["latency"] + random.uniform(0, settings["jitter"])
+    if delay > 0:
+        time.sleep(delay)
+    if settings["error_rate"] > 0 and random.random() < settings["error_rate"]:
+        return erddap_error(settings["error_status"], "Injected error from the mock ERDDAP server.")
+    return None
+
+
+@server.route("/erddap/tabledap/<did>.csv")
+def tabledap(did):
+    if did not in known_datasets():
+        return erddap_error(404, f"Resource not found: datasetID={did}")
+    # The raw query string, so that quoted constraints keep their & and quotes.
+    query_string = flask.request.query_string.decode()
+    try:
+        df = fixtures.query(did, query_string)
+    except fixtures.NoMatchingRows:
+        return erddap_error(404, "Not Found: Your query produced no matching results. (nRows = 0)")
+    except (KeyError, ValueError) as e:
+        return erddap_error(400, f"Bad Request: Query error: {e}")
+    return flask.Response(fixtures.to_csv(df), mimetype="text/csv")
+
+
+def coverage(did):
+    # From the deployments seed.py made up and the recorded fixtures, without loading every series.
+    starts = []
+    ends = []
+    sites = fixtures.synthetic_sites()
+    sites = sites.loc[sites["family"] == seed.family(did)]
+    if sites.shape[0] > 0:
+        starts.append(np.datetime64(int(sites["first_month"].min()), "M").astype("datetime64[s]"))
+        ends.append(np.datetime64(int(sites["last_month"].max()) + 1, "M").astype("datetime64[s]"))
+    for site_code in fixtures.recorded_sites(did):
+        times = fixtures.load_fixture(did, site_code, ())["_time"]
+        starts.append(times.min().tz_localize(None).to_datetime64())
+        ends.append(times.max().tz_localize(None).to_datetime64())
+    if len(starts) == 0:
+        return pd.Timestamp(fixtures.synthetic_start, tz="UTC"), pd.Timestamp(fixtures.synthetic_end, tz="UTC")
+    return pd.Timestamp(min(starts), tz="UTC"), pd.Timestamp(max(ends), tz="UTC")
+
+
+def info_rows(did):
+    discovery_json, platform_json = seed.load_config()
+    variables = seed.variables_by_did(discovery_json).get(did, [])
+    start, end = coverage(did)
+    rows = [
+        ["attribute", "NC_GLOBAL", "title", "String", "Mock " + did],
+        ["attribute", "NC_GLOBAL", "time_coverage_start", "String", start.strftime("%Y-%m-%dT%H:%M:%SZ")],
+        ["attribute", "NC_GLOBAL", "time_coverage_end", "String", end.strftime("%Y-%m-%dT%H:%M:%SZ")],
+        ["variable", "site_code", "", "String", ""],
+        ["variable", "wmo_platform_code", "", "String", ""],
+        ["variable", "latitude", "", "float", ""],
+        ["attribute", "latitude", "units", "String", "degrees_north"],
+        ["variable", "longitude", "", "float", ""],
+        ["attribute", "longitude", "units", "String", "degrees_east"],
+        ["variable", "time", "", "double", ""],
+        ["attribute", "time", "actual_range", "double", f"{start.timestamp()}, {end.timestamp()}"],
+        ["attribute", "time", "units", "String", "seconds since 1970-01-01T00:00:00Z"],
+    ]
+    for v in variables:
+        rows.append(["variable", v, "", "float", ""])
+        rows.append(["attribute", v, "long_name", "String", v])
+        rows.append(["attribute", v, "units", "String", "N/m2" if v.startswith("TAU") else "W/m2"])
+    return rows
+
+
+@server.route("/erddap/info/<did>/index.<extension>")
+def info(did, extension):
+    if did not in known_datasets():
+        return erddap_error(404, f"Resource not found: datasetID={did}")
+    columns = ["Row Type", "Variable Name", "Attribute Name", "Data Type", "Value"]
+    rows = info_rows(did)
+    if extension == "json":
+        table = {"table": {"columnNames": columns, "columnTypes": ["String"] * 5, "rows": rows}}
+        return flask.Response(json.dumps(table), mimetype="application/json")
+    if extension == "csv":
+        return flask.Response(pd.DataFrame(rows, columns=columns).to_csv(index=False), mimetype="text/csv")
+    return erddap_error(400, f"Bad Request: unsupported file type .{extension}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the benchmark fixtures as a local ERDDAP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--scale", type=int, default=fixtures.site_scale, help="serve the sites seed.py makes at this scale")
+    parser.add_argument("--latency", type=float, default=settings["latency"], help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=settings["jitter"], help="up to this many more seconds, at random")
+    parser.add_argument("--error-rate", type=float, default=settings["error_rate"], help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=settings["error_status"])
+    args = parser.parse_args(argv)
+    fixtures.site_scale = args.scale
+    settings.update(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status
+    )
+    server.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
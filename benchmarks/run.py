@@ -0,0 +1,271 @@
+import argparse
+import datetime
+import importlib.metadata
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, root)
+
+# Benchmarks of the callbacks, called directly as Python functions against synthetic tables
+# (seed.py) and ERDDAP responses from fixtures.py: recorded ones where benchmarks/fixtures/ has
+# them, seeded synthetic series for the other data sets. The results list which is which, and a
+# run without any recordings says so when it starts. For every scale the tables are rebuilt
+# with base_sites x scale sites and each case is timed; one more call runs under tracemalloc for
+# the peak memory. The results go to benchmarks/results/ tagged with the git commit, and
+# compare.py lines up two of them.
+#
+#   python benchmarks/run.py                     1x, 10x and 100x on benchmarks/bench.db
+#   python benchmarks/run.py --scales 1 --repeat 3
+#   DATABASE_URL=postgresql://... python benchmarks/run.py
+#
+# Redis is left to REDIS_URL like in the app, but each uncached case uses fresh keys. The time
+# series cache lives in a temporary directory and is cleared before each cold plot.
+
+default_scales = [1, 10, 100]
+package_names = ["dash", "pandas", "numpy", "plotly", "sqlalchemy"]
+
+
+def configure(database_url, cache_dir):
+    # Has to happen before constants, refdata or the app are imported.
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["REFDATA_CHECK_SECONDS"] = "0"
+    os.environ["METRICS"] = "false"
+    os.environ["ERDDAP_CACHE_DIR"] = cache_dir
+    # A cold plot has to read the fixtures, not the result an earlier call shared in Redis.
+    os.environ["ERDDAP_SINGLE_FLIGHT"] = "false"
+    os.environ["SNAPSHOT_FILE"] = os.path.join(cache_dir, "startup_snapshot.json")
+    os.environ.setdefault("REDIS_TIMEOUT", "0.1")
+    # app.py opens flux_discovery.json and oceansites_flux_list.json from the working directory.
+    os.chdir(root)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, status.strip() != ""
+
+
+def package_versions():
+    versions = {"python": sys.version.split()[0]}
+    for name in package_names:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def measure(call, repeat, before=None):
+    # before runs ahead of every call without being timed, e.g. to empty a cache.
+    seconds = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = timeit.default_timer()
+        call()
+        seconds.append(timeit.default_timer() - start)
+    if before is not None:
+        before()
+    tracemalloc.start()
+    try:
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    seconds.sort()
+    return {
+        "n": repeat,
+        "min": seconds[0],
+        "p50": statistics.median(seconds),
+        "mean": statistics.fmean(seconds),
+        "max": seconds[-1],
+        "peak_bytes": peak,
+    }
+
+
+def in_context(triggered):
+    # make_location_map reads ctx.triggered, which is only set inside a Dash request.
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+
+    context_value.set(AttributeDict(triggered_inputs=[{"prop_id": prop_id, "value": None} for prop_id in triggered]))
+
+
+def busiest_sites(refdata, question, count):
+    # The sites with the most data sets for the question, the plots with the most subplots.
+    tables = refdata.get_tables()
+    per_site = [(len(df), key[0]) for key, df in tables["discovery_by_site"].items() if key[1] == question]
+    return [site for n, site in sorted(per_site, reverse=True)[:count]]
+
+
+def fresh_keys(redis_cache):
+    redis_cache.key_prefix = "flux-bench-" + datetime.datetime.now().strftime("%H%M%S%f")
+
+
+def run_scale(app, scale, repeat):
+    import availability
+    import erddap_cache
+    import plots
+    import redis_cache
+    import refdata
+    import snapshot
+
+    cases = {}
+    # The tables were just rebuilt, so the snapshot is too, without waiting for the background refresh.
+    startup = snapshot.refresh()
+    discovery = startup["discovery"]["discovery"]
+    version = refdata.build_version()
+    locations = refdata.locations()
+    end = datetime.date.fromisoformat(str(startup["all_end"])[:10])
+    ranges = {
+        "all": (str(startup["all_start"])[:10], str(startup["all_end"])[:10]),
+        "10y": ((end - datetime.timedelta(days=3652)).isoformat(), end.isoformat()),
+        "1y": ((end - datetime.timedelta(days=365)).isoformat(), end.isoformat()),
+    }
+
+    cases["availability.load_cube"] = measure(lambda: availability.load_cube(discovery), repeat)
+    cases["refdata.load_tables"] = measure(refdata.load_tables, repeat)
+    # The per-process copies are loaded once ahead of the callbacks, as a running worker has them.
+    availability.get_cube(discovery)
+    refdata.get_tables()
+
+    for question in discovery:
+        for name, (start, stop) in ranges.items():
+            cases[f"update_platform_state[{question},{name}]"] = measure(
+                lambda: app.update_platform_state(start, stop, question), repeat, before=lambda: fresh_keys(redis_cache)
+            )
+        for search in discovery[question]["search"]:
+            start, stop = ranges["10y"]
+            cases[f"sites_with_data_sql[{availability.nobs_table(search['short_names'])},10y]"] = measure(
+                lambda: availability.sites_with_data_sql(
+                    search, datetime.datetime.fromisoformat(start), datetime.datetime.fromisoformat(stop)
+                ),
+                repeat,
+            )
+    question = next(iter(discovery))
+    start, stop = ranges["all"]
+    fresh_keys(redis_cache)
+    app.update_platform_state(start, stop, question)
+    cases["update_platform_state[cached]"] = measure(lambda: app.update_platform_state(start, stop, question), repeat)
+
+    active, _ = app.update_platform_state(start, stop, question)
+    first = locations.iloc[0]
+    selected = json.dumps({"site_code": str(first["site_code"]), "lat": float(first["latitude"]), "lon": float(first["longitude"])})
+
+    def full_map():
+        in_context(["active-platforms.data"])
+        return app.make_location_map(active, None, None, None, start, stop, question)
+
+    def patched_map():
+        in_context(["selected-platform.data"])
+        return app.make_location_map(active, selected, None, version or "unversioned", start, stop, question)
+
+    cases["make_location_map[full]"] = measure(full_map, repeat)
+    cases["make_location_map[patch]"] = measure(patched_map, repeat)
+
+    cache = erddap_cache.get_cache()
+    for site in busiest_sites(refdata, question, 2):
+        row = locations.loc[locations["site_code"] == site].iloc[0]
+        selection = json.dumps({"site_code": site, "lat": float(row["latitude"]), "lon": float(row["longitude"])})
+        for name in ("all", "1y"):
+            start, stop = ranges[name]
+
+            def plot():
+                return plots.plot_from_selected_platform(lambda progress: None, None, selection, start, stop, active, question)
+
+            # The first call loads the fixtures into memory so that cold means an empty disk cache,
+            # not fixture parsing.
+            result = plot()
+            cases[f"plot_from_selected_platform[{site},{name},cold]"] = measure(plot, repeat, before=cache.clear)
+            cases[f"plot_from_selected_platform[{site},{name},warm]"] = measure(plot, repeat)
+        plot_traces = result[5]
+        zoom_end = datetime.date.fromisoformat(stop)
+        relayout = {
+            "xaxis.range[0]": (zoom_end - datetime.timedelta(days=30)).isoformat(),
+            "xaxis.range[1]": zoom_end.isoformat(),
+        }
+        cases[f"refine_plot_on_zoom[{site},30d]"] = measure(lambda: app.refine_plot_on_zoom(relayout, plot_traces), repeat)
+
+        series = erddap_cache.get_series(plot_traces[0]["url"], plot_traces[0]["did"], site, plot_traces[0]["variables"], ranges["all"][0], ranges["all"][1])
+        cases[f"make_gaps[{site}]"] = measure(lambda: plots.make_gaps(series, "1h"), repeat)
+    return cases
+
+
+def print_cases(scale, cases):
+    print(f"\n{scale}x")
+    for name, result in cases.items():
+        print(f"  {name:70s} p50 {result['p50'] * 1000:9.1f} ms  max {result['max'] * 1000:9.1f} ms  peak {result['peak_bytes'] / 2**20:8.1f} MiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the dashboard callbacks on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="+", default=default_scales, help="multiples of BENCH_BASE_SITES sites")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per case")
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL", "sqlite:///" + os.path.join(here, "bench.db")))
+    parser.add_argument("--output", default=os.path.join(here, "results"), help="directory for the results file")
+    args = parser.parse_args(argv)
+
+    cache_dir = tempfile.mkdtemp(prefix="flux-bench-")
+    configure(args.database_url, cache_dir)
+    import erddap_cache
+    import fixtures
+    import seed
+
+    # Replay instead of going to ERDDAP.
+    erddap_cache.read_erddap_csv = fixtures.read_erddap_csv
+    series = fixtures.series_sources([seed.did_of(url) for url in seed.dataset_urls(*seed.load_config())])
+    synthetic = [did for did, sites in series.items() if sites == "synthetic"]
+    if len(synthetic) > 0:
+        print(f"No recorded ERDDAP responses for {', '.join(synthetic)}, their time series are synthetic.")
+        print("Record them with: python benchmarks/fixtures.py record-set")
+
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "versions": package_versions(),
+        "database": args.database_url.split(":", 1)[0],
+        "base_sites": seed.base_sites,
+        "repeat": args.repeat,
+        "series": series,
+        "scales": {},
+    }
+    app = None
+    try:
+        for scale in args.scales:
+            rows = seed.seed(scale, *seed.load_config())
+            # The replayed data sets have the same sites as the tables.
+            fixtures.site_scale = scale
+            fixtures.synthetic_sites.cache_clear()
+            fixtures.dataset_sites.cache_clear()
+            if app is None:
+                import app
+            cases = run_scale(app, scale, args.repeat)
+            results["scales"][str(scale)] = {"rows": rows, "cases": cases}
+            print_cases(scale, cases)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    os.makedirs(args.output, exist_ok=True)
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(args.output, f"{stamp}-{commit[:10]}{'-dirty' if dirty else ''}.json")
+    with open(path, "w") as results_stream:
+        json.dump(results, results_stream, indent=2)
+    print("\nWrote", path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import constants
+import availability
+import nobs_db
+
+# Synthetic versions of the tables make_nobs_db builds, for the benchmarks. The data sets, the
+# questions and the variables are the real ones from flux_discovery.json and
+# oceansites_flux_list.json; the sites are made up, base_sites x scale of them shared round robin
+# among the families of data sets (tao_*, ocs_*, WHOI_*, so a TAO site is in every TAO data set
+# like the real ones), each with its own deployment years. Everything is seeded, so the same scale
+# gives the same tables on every run. The tables go to whatever DATABASE_URL points at (the
+# benchmarks default to a SQLite file).
+
+base_sites = int(os.environ.get("BENCH_BASE_SITES", 80))
+first_year = 1980
+last_year = 2024
+
+
+def did_of(url):
+    return url[url.rindex("/") + 1:]
+
+
+def dataset_urls(discovery_json, platform_json):
+    urls = [dataset["url"] for dataset in platform_json["config"]["datasets"]]
+    for question in discovery_json["discovery"].values():
+        for search in question["search"]:
+            for url in search["datasets"]:
+                if url not in urls:
+                    urls.append(url)
+    return urls
+
+
+def variables_by_did(discovery_json):
+    variables = {}
+    for question in discovery_json["discovery"].values():
+        for search in question["search"]:
+            for url in search["datasets"]:
+                did = did_of(url)
+                variables[did] = variables.get(did, []) + [v for v in search["short_names"] if v not in variables.get(did, [])]
+    return variables
+
+
+def family(did):
+    return did.split("_")[0]
+
+
+def make_sites(urls, scale, rng):
+    n_sites = base_sites * scale
+    sites = pd.DataFrame(
+        {
+            "site_code": [f"S{n:05d}" for n in range(n_sites)],
+            "wmo_platform_code": [str(10000 + n) for n in range(n_sites)],
+            "latitude": rng.uniform(-60, 60, n_sites),
+            "longitude": rng.uniform(-180, 180, n_sites),
+        }
+    )
+    families = sorted(set(family(did_of(url)) for url in urls))
+    sites["family"] = [families[n % len(families)] for n in range(n_sites)]
+    # Deployments are kept as month numbers (months since 1970-01), as the availability cube does.
+    start = (rng.integers(first_year, last_year - 4, n_sites) - 1970) * 12 + rng.integers(0, 12, n_sites)
+    end = np.minimum(start + 12 * rng.integers(5, 31, n_sites), (last_year - 1970) * 12 + 11)
+    sites["first_month"] = start
+    sites["last_month"] = end
+    return sites
+
+
+def make_nobs(sites, dids, short_names, rng):
+    frames = []
+    pairs = [(site, did) for site in sites.to_dict(orient="records") for did in dids if family(did) == site["family"]]
+    for site, did in pairs:
+        months = np.arange(site["first_month"], site["last_month"] + 1).astype("datetime64[M]")
+        df = pd.DataFrame({"time": np.char.add(months.astype(str), "-01T00:00:00Z")})
+        for short in short_names:
+            counts = rng.integers(0, 745, months.shape[0]).astype(np.float64)
+            # Instruments fail: some months have no count for a variable at all.
+            counts[rng.random(months.shape[0]) < 0.1] = np.nan
+            df[short] = counts
+        df["wmo_platform_code"] = site["wmo_platform_code"]
+        df["site_code"] = site["site_code"]
+        df["did"] = did
+        frames.append(df)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=short_names + ["time", "wmo_platform_code", "site_code", "did"])
+    return pd.concat(frames, ignore_index=True)[short_names + ["time", "wmo_platform_code", "site_code", "did"]]
+
+
+def make_metadata(urls, sites):
+    rows = []
+    for url in urls:
+        did = did_of(url)
+        mine = sites.loc[sites["family"] == family(did)]
+        start = mine["first_month"].min() if mine.shape[0] > 0 else (first_year - 1970) * 12
+        end = mine["last_month"].max() + 1 if mine.shape[0] > 0 else (last_year - 1970) * 12 + 12
+        start = pd.Timestamp(np.datetime64(int(start), "M").astype("datetime64[s]"), tz="UTC")
+        end = pd.Timestamp(np.datetime64(int(end), "M").astype("datetime64[s]"), tz="UTC")
+        rows.append(
+            {
+                "url": url,
+                "locations": url + ".csv?site_code%2Cwmo_platform_code%2Clatitude%2Clongitude&distinct()",
+                "id": did,
+                "title": "Synthetic " + did,
+                "start_date": start.strftime("%Y-%m-%d"),
+                "end_date": end.strftime("%Y-%m-%d"),
+                "start_date_seconds": start.timestamp(),
+                "end_date_seconds": end.timestamp(),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def make_discovery(discovery_json, sites):
+    frames = []
+    for question_id, question in discovery_json["discovery"].items():
+        for search in question["search"]:
+            for url in search["datasets"]:
+                df = sites.loc[sites["family"] == family(did_of(url)), ["site_code"]].copy()
+                df["question_id"] = question_id
+                df["question_title"] = question["question"]
+                df["short_string"] = ",".join(search["short_names"])
+                df["did"] = did_of(url)
+                frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def seed(scale, discovery_json, platform_json, seed_value=0):
+    rng = np.random.default_rng(seed_value + scale)
+    urls = dataset_urls(discovery_json, platform_json)
+    sites = make_sites(urls, scale, rng)
+    variables = variables_by_did(discovery_json)
+    tables = {
+        "locations": sites[["site_code", "wmo_platform_code", "latitude", "longitude"]],
+        "metadata": make_metadata(urls, sites),
+        "units": pd.DataFrame(
+            [dict({"did": did}, **{v: "N/m2" if v.startswith("TAU") else "W/m2" for v in variables[did]}) for did in variables]
+        ),
+        "discovery": make_discovery(discovery_json, sites),
+        "variables": pd.DataFrame([{"did": did, "short_name": v} for did in variables for v in variables[did]]),
+    }
+    seen = []
+    for question in discovery_json["discovery"].values():
+        for search in question["search"]:
+            table = availability.nobs_table(search["short_names"])
+            if table not in seen:
+                seen.append(table)
+                tables[table] = make_nobs(sites, [did_of(url) for url in search["datasets"]], search["short_names"], rng)
+    with constants.postgres_engine.begin() as conn:
+        for table, df in tables.items():
+            df.to_sql(table, index=False, con=conn, if_exists="replace", chunksize=10000)
+            nobs_db.create_indexes(conn, table)
+        now = pd.Timestamp.now(tz="UTC")
+        pd.DataFrame([{"version": f"bench-{scale}x-" + now.strftime("%Y%m%dT%H%M%S.%fZ"), "built_at": now.isoformat()}]).to_sql(
+            "build_info", index=False, con=conn, if_exists="replace"
+        )
+    return {table: df.shape[0] for table, df in tables.items()}
+
+
+def load_config():
+    root = os.path.dirname(here)
+    with open(os.path.join(root, "flux_discovery.json")) as discovery_stream:
+        discovery_json = json.load(discovery_stream)
+    with open(os.path.join(root, "oceansites_flux_list.json")) as platform_stream:
+        platform_json = json.load(platform_stream)
+    return discovery_json, platform_json
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    print(seed(scale, *load_config()))
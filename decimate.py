@@ -0,0 +1,126 @@
+import numpy as np
+
+# Shape preserving decimation for the time series plots. Both methods split the series into
+# equal count buckets and pick real samples out of each bucket, so spikes and extremes survive
+# where a random sample would drop them. They return the indices of the samples to keep, in
+# order, and the caller slices whichever columns it needs.
+#
+#   minmax: the smallest and largest value of every bucket, plus the first and last sample.
+#   lttb:   largest triangle three buckets, the sample in each bucket that makes the largest
+#           triangle with its neighbours. The left vertex is the previous bucket's average
+#           rather than the previous pick so that every bucket is computed in one pass.
+#
+# Missing values break the plotted line, so a gap between two kept samples is marked by putting
+# back one of its missing values. Those markers come out of n_out as well: one per run of missing
+# values is set aside, up to half of n_out, and the buckets share the rest. When there are more
+# gaps than markers the widest gaps keep theirs.
+
+modes = ["minmax", "lttb"]
+
+
+def _bucket_index(start, stop, n_buckets):
+    # A (bucket x slot) matrix of positions in [start, stop) padded with the last position of
+    # each bucket, plus the mask of the slots that are real.
+    edges = np.linspace(start, stop, n_buckets + 1).astype(np.int64)
+    width = max(int(np.diff(edges).max()), 1)
+    index = edges[:-1, None] + np.arange(width)[None, :]
+    valid = index < edges[1:, None]
+    index = np.minimum(index, np.maximum(edges[1:, None] - 1, edges[:-1, None]))
+    return edges, index, valid
+
+
+def _bucket_mean(values, index, valid):
+    usable = valid & np.isfinite(values[index])
+    counts = usable.sum(axis=1)
+    sums = np.where(usable, values[index], 0.0).sum(axis=1)
+    means = np.full(index.shape[0], np.nan)
+    means[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    return means
+
+
+def _endpoints(n, n_out):
+    # For a budget too small for any bucket: the first and last sample, as many as fit.
+    return np.array([0, n - 1])[:max(n_out, 0)]
+
+
+def _gap_share(y, n_out):
+    # The markers set aside for gaps: one per run of missing values, at most half of n_out.
+    missing = np.isnan(y)
+    runs = int(np.count_nonzero(missing[1:] & ~missing[:-1])) + int(missing[:1].sum())
+    return min(runs, n_out // 2)
+
+
+def _keep_gaps(y, keep, n_gaps):
+    # Put back the first missing value between two kept samples that had missing values between
+    # them, so the plot still breaks the line where the data has a gap. At most n_gaps are put
+    # back, the ones with the most samples between their kept neighbours first.
+    nan_pos = np.flatnonzero(np.isnan(y))
+    if nan_pos.shape[0] == 0 or keep.shape[0] < 2 or n_gaps < 1:
+        return keep
+    following = np.searchsorted(nan_pos, keep[:-1], side="right")
+    exists = following < nan_pos.shape[0]
+    first_nan = nan_pos[np.minimum(following, nan_pos.shape[0] - 1)]
+    between = np.flatnonzero(exists & (first_nan < keep[1:]))
+    if between.shape[0] > n_gaps:
+        width = keep[between + 1] - keep[between]
+        between = between[np.argsort(-width, kind="stable")[:n_gaps]]
+    return np.union1d(keep, first_nan[between])
+
+
+def minmax(x, y, n_out):
+    n = y.shape[0]
+    if n <= n_out:
+        return np.arange(n)
+    if n_out < 4:
+        return _endpoints(n, n_out)
+    n_gaps = _gap_share(y, n_out)
+    # The first and last samples are always kept, the buckets share what is left.
+    n_buckets = max((n_out - n_gaps - 2) // 2, 1)
+    edges, index, valid = _bucket_index(1, n - 1, n_buckets)
+    values = y[index]
+    low = np.where(valid & ~np.isnan(values), values, np.inf)
+    high = np.where(valid & ~np.isnan(values), values, -np.inf)
+    rows = np.arange(n_buckets)
+    i_min = index[rows, np.argmin(low, axis=1)]
+    i_max = index[rows, np.argmax(high, axis=1)]
+    keep = np.unique(np.concatenate([[0], i_min, i_max, [n - 1]]))
+    return _keep_gaps(y, keep, n_out - keep.shape[0])
+
+
+def lttb(x, y, n_out):
+    n = y.shape[0]
+    if n <= n_out:
+        return np.arange(n)
+    if n_out < 3:
+        return _endpoints(n, n_out)
+    xf = (x - x[0]).astype(np.float64)
+    yf = y.astype(np.float64)
+    n_gaps = _gap_share(y, n_out)
+    # The first and last samples are always kept, the buckets share what is left.
+    n_buckets = max(n_out - n_gaps - 2, 1)
+    edges, index, valid = _bucket_index(1, n - 1, n_buckets)
+    x_mean = _bucket_mean(xf, index, valid)
+    y_mean = _bucket_mean(yf, index, valid)
+    fill = np.nanmean(yf) if np.isfinite(yf).any() else 0.0
+    y_mean = np.where(np.isnan(y_mean), fill, y_mean)
+    x_mean = np.where(np.isnan(x_mean), (xf[edges[:-1]] + xf[edges[1:] - 1]) / 2.0, x_mean)
+    a_x = np.concatenate([[xf[0]], x_mean[:-1]])
+    a_y = np.concatenate([[yf[0]], y_mean[:-1]])
+    c_x = np.concatenate([x_mean[1:], [xf[-1]]])
+    c_y = np.concatenate([y_mean[1:], [yf[-1]]])
+    px = xf[index]
+    py = yf[index]
+    area = np.abs(
+        (a_x[:, None] - c_x[:, None]) * (py - a_y[:, None])
+        - (a_x[:, None] - px) * (c_y[:, None] - a_y[:, None])
+    )
+    area = np.where(valid & np.isfinite(area), area, -1.0)
+    picks = index[np.arange(n_buckets), np.argmax(area, axis=1)]
+    keep = np.unique(np.concatenate([[0], picks, [n - 1]]))
+    return _keep_gaps(y, keep, n_out - keep.shape[0])
+
+
+def decimate(x, y, n_out, mode="minmax"):
+    if mode == "lttb":
+        return lttb(x, y, n_out)
+    return minmax(x, y, n_out)
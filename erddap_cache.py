@@ -0,0 +1,333 @@
+import hashlib
+import io
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote
+
+import diskcache
+import numpy as np
+import pandas as pd
+
+import constants
+import redis_cache
+
+# Time series read from ERDDAP for the plots are kept on local disk, one entry per
+# (dataset, site, variables) with the time spans that have been fetched so far. A request is answered
+# by slicing the cached columns, and only the parts of the range that were never fetched go to
+# ERDDAP. The entries are plain NumPy columns in a diskcache with a size cap and least recently
+# used eviction; ERDDAP_CACHE_SECONDS bounds how long an entry lives before it is read again.
+
+cache_dir = os.environ.get("ERDDAP_CACHE_DIR", "./erddap_cache")
+cache_bytes = int(os.environ.get("ERDDAP_CACHE_BYTES", 2 * 1024 * 1024 * 1024))
+cache_seconds = int(os.environ.get("ERDDAP_CACHE_SECONDS", 24 * 60 * 60))
+
+# A plot reads up to four datasets, they are fetched side by side by this many threads and each
+# one gets ERDDAP_TIMEOUT seconds.
+fetch_workers = int(os.environ.get("ERDDAP_FETCH_WORKERS", 4))
+fetch_timeout = float(os.environ.get("ERDDAP_TIMEOUT", 120))
+# How often get_many asks its give_up function and reports progress while the fetches run.
+check_seconds = 0.5
+
+# The same request from several workers at once (a shared deep link, a popular station) goes to
+# ERDDAP once: the first worker takes a lease in Redis on the normalized URL, the others poll for
+# the columns it publishes under the result key. The lease is short and renewed while the fetch
+# runs, so it lapses soon after a worker that dies mid-fetch (say a plot job that was terminated).
+# A waiter fetches for itself when Redis is down, when the lease ends without a result (the fetch
+# failed, the worker died, or the result was too big to share) or after waiting half of
+# ERDDAP_TIMEOUT, which leaves it the other half before get_many gives up on the dataset.
+single_flight = os.environ.get("ERDDAP_SINGLE_FLIGHT", "true").lower() == "true"
+lease_seconds = 10
+wait_seconds = fetch_timeout / 2
+result_seconds = int(os.environ.get("ERDDAP_SHARED_SECONDS", 60))
+result_max_bytes = int(os.environ.get("ERDDAP_SHARED_BYTES", 16 * 1024 * 1024))
+poll_seconds = 0.25
+
+erddap_time_format = "%Y-%m-%dT%H:%M:%SZ"
+
+# Returned by redis_cache.run when Redis is not there, as opposed to a lease someone else holds.
+_no_redis = object()
+_release_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_renew_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_cache = None
+_cache_pid = None
+
+
+def get_cache():
+    global _cache, _cache_pid
+    if _cache is None or _cache_pid != os.getpid():
+        _cache = diskcache.Cache(
+            cache_dir,
+            size_limit=cache_bytes,
+            eviction_policy="least-recently-used",
+        )
+        _cache_pid = os.getpid()
+    return _cache
+
+
+def to_ns(value):
+    return pd.Timestamp(value).value
+
+
+def series_url(url, site_code, variables, start_ns, end_ns):
+    start = pd.Timestamp(start_ns).strftime(erddap_time_format)
+    end = pd.Timestamp(end_ns).strftime(erddap_time_format)
+    return (
+        url
+        + ".csv?"
+        + ",".join(variables)
+        + ",site_code,time"
+        + "&time>="
+        + start
+        + "&time<="
+        + end
+        + "&site_code="
+        + quote('"' + site_code + '"')
+    )
+
+
+def read_erddap_csv(url):
+    try:
+        with urllib.request.urlopen(constants.erddap_url(url), timeout=fetch_timeout) as response:
+            return pd.read_csv(response, skiprows=[1])
+    except urllib.error.HTTPError as e:
+        # ERDDAP answers a query with no matching rows with a 404.
+        if e.code == 404:
+            return None
+        raise
+
+
+def read_span(request, variables):
+    df = read_erddap_csv(request)
+    if df is None or df.empty:
+        return np.empty(0, dtype=np.int64), {v: np.empty(0) for v in variables}
+    times = (
+        pd.to_datetime(df["time"], utc=True)
+        .dt.tz_localize(None)
+        .values.astype("datetime64[ns]")
+        .astype(np.int64)
+    )
+    columns = {v: df[v].to_numpy(dtype=np.float64) for v in variables}
+    return times, columns
+
+
+def normalize_url(url):
+    # One key for the same request however it is spelled: host case and percent encoding.
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.unquote(parts.query)
+    return f"{parts.scheme.lower()}://{parts.netloc.lower()}{parts.path}?{query}"
+
+
+def pack_span(times, columns):
+    buffer = io.BytesIO()
+    np.savez(buffer, time=times, **{"column_" + v: columns[v] for v in columns})
+    return buffer.getvalue()
+
+
+def unpack_span(packed, variables):
+    with np.load(io.BytesIO(packed), allow_pickle=False) as arrays:
+        return arrays["time"], {v: arrays["column_" + v] for v in variables}
+
+
+def share_span(result_key, times, columns):
+    packed = pack_span(times, columns)
+    if len(packed) > result_max_bytes:
+        return
+    redis_cache.run(lambda client: client.set(result_key, packed, ex=result_seconds))
+
+
+def shared_span(result_key, variables):
+    packed = redis_cache.run(lambda client: client.get(result_key))
+    if packed is None:
+        return None
+    return unpack_span(packed, variables)
+
+
+def renew_lease(lease_key, token, done):
+    while not done.wait(lease_seconds / 3):
+        redis_cache.run(lambda client: client.eval(_renew_script, 1, lease_key, token, lease_seconds))
+
+
+def fetch_span(url, site_code, variables, start_ns, end_ns):
+    request = series_url(url, site_code, variables, start_ns, end_ns)
+    if not single_flight:
+        return read_span(request, variables)
+    key = redis_cache.make_key("erddap", hashlib.sha1(normalize_url(request).encode()).hexdigest())
+    lease_key = key + ":lease"
+    result_key = key + ":result"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        found = shared_span(result_key, variables)
+        if found is not None:
+            return found
+        leased = redis_cache.run(
+            lambda client: client.set(lease_key, token, nx=True, ex=lease_seconds), default=_no_redis
+        )
+        if leased is _no_redis or time.monotonic() > deadline:
+            return read_span(request, variables)
+        if leased:
+            break
+        time.sleep(poll_seconds)
+    done = threading.Event()
+    threading.Thread(target=renew_lease, args=(lease_key, token, done), daemon=True).start()
+    try:
+        times, columns = read_span(request, variables)
+        share_span(result_key, times, columns)
+    finally:
+        done.set()
+        redis_cache.run(lambda client: client.eval(_release_script, 1, lease_key, token))
+    return times, columns
+
+
+def missing_spans(spans, start_ns, end_ns):
+    # spans is sorted and non-overlapping, the result is what [start_ns, end_ns] still needs.
+    if start_ns == end_ns:
+        # A single instant is missing unless a span holds it.
+        return [] if any(s0 <= start_ns <= s1 for s0, s1 in spans) else [(start_ns, end_ns)]
+    missing = []
+    cursor = start_ns
+    for s0, s1 in spans:
+        if s1 < cursor:
+            continue
+        if s0 > end_ns:
+            break
+        if s0 > cursor:
+            missing.append((cursor, min(s0, end_ns)))
+        cursor = max(cursor, s1)
+        if cursor >= end_ns:
+            break
+    if cursor < end_ns:
+        missing.append((cursor, end_ns))
+    return missing
+
+
+def merge_spans(spans):
+    merged = []
+    for s0, s1 in sorted(spans):
+        if len(merged) > 0 and s0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], s1))
+        else:
+            merged.append((s0, s1))
+    return merged
+
+
+def merge_columns(entry, times, columns):
+    all_times = np.concatenate([entry["time"], times])
+    order = np.argsort(all_times, kind="stable")
+    all_times = all_times[order]
+    # The spans share their end points so the boundary rows can come back twice.
+    keep = np.ones(all_times.shape[0], dtype=bool)
+    keep[1:] = all_times[1:] != all_times[:-1]
+    entry["time"] = all_times[keep]
+    for v in entry["columns"]:
+        entry["columns"][v] = np.concatenate([entry["columns"][v], columns[v]])[order][keep]
+
+
+def cached_entry(cache, key, now_ns):
+    entry = cache.get(key)
+    if entry is None or now_ns - entry["created"] > cache_seconds * 1e9:
+        return None
+    return entry
+
+
+def slice_entry(entry, site_code, variables, start_ns, end_ns):
+    lo = np.searchsorted(entry["time"], start_ns, side="left")
+    hi = np.searchsorted(entry["time"], end_ns, side="right")
+    df = pd.DataFrame({v: entry["columns"][v][lo:hi] for v in variables})
+    df["site_code"] = site_code
+    df["time"] = pd.to_datetime(entry["time"][lo:hi])
+    return df
+
+
+def get_series(url, did, site_code, variables, start, end, on_cached=None):
+    # on_cached, when given, gets the rows the cache already has in the range before the rest is
+    # read from ERDDAP; it is not called when the cache has none or has all of them.
+    cache = get_cache()
+    key = ("erddap", did, site_code, tuple(variables))
+    start_ns = to_ns(start)
+    end_ns = to_ns(end)
+    now_ns = pd.Timestamp.now(tz="UTC").tz_localize(None).value
+    entry = cached_entry(cache, key, now_ns)
+    if entry is None:
+        entry = {
+            "created": now_ns,
+            "time": np.empty(0, dtype=np.int64),
+            "columns": {v: np.empty(0) for v in variables},
+            "spans": [],
+        }
+    missing = missing_spans(entry["spans"], start_ns, end_ns)
+    if len(missing) > 0:
+        if on_cached is not None and len(entry["spans"]) > 0:
+            cached = slice_entry(entry, site_code, variables, start_ns, end_ns)
+            if cached.shape[0] > 0:
+                on_cached(cached)
+        # Data past the present can still arrive, so only mark what has already happened as fetched.
+        for s0, s1 in missing:
+            times, columns = fetch_span(url, site_code, variables, s0, s1)
+            merge_columns(entry, times, columns)
+            entry["spans"].append((s0, min(s1, now_ns)))
+        entry["spans"] = merge_spans([s for s in entry["spans"] if s[1] >= s[0]])
+        cache.set(key, entry, expire=cache_seconds)
+
+    return slice_entry(entry, site_code, variables, start_ns, end_ns)
+
+
+def get_many(requests, give_up=None, progress=None, timeout=None):
+    # Runs get_series for each dict of arguments concurrently. The results come back in the same
+    # order, with the exception in place of the frame for any dataset that failed or is not back
+    # within timeout seconds (ERDDAP_TIMEOUT by default); those fetches carry on in the background.
+    # When give_up() turns true during the wait the result is None; the fetches already running
+    # carry on in the background and still fill the cache. progress(results, cached) is called
+    # every check_seconds while some datasets are still being read, with None in results for
+    # those and, in cached, the rows the disk cache already had for them (None when it had none).
+    if len(requests) == 0:
+        return []
+    results = [None] * len(requests)
+    cached = [None] * len(requests)
+
+    def read(i, request):
+        def keep(df):
+            cached[i] = df
+
+        return get_series(**request, on_cached=None if progress is None else keep)
+
+    executor = ThreadPoolExecutor(max_workers=min(fetch_workers, len(requests)))
+    futures = [executor.submit(read, i, request) for i, request in enumerate(requests)]
+    if timeout is None:
+        timeout = fetch_timeout
+    deadline = time.monotonic() + timeout
+    not_done = set(futures)
+    while len(not_done) > 0 and time.monotonic() < deadline:
+        remaining = deadline - time.monotonic()
+        if give_up is not None or progress is not None:
+            remaining = min(remaining, check_seconds)
+        done, not_done = wait(not_done, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            error = future.exception()
+            results[futures.index(future)] = future.result() if error is None else error
+        if len(not_done) > 0 and give_up is not None and give_up():
+            executor.shutdown(wait=False, cancel_futures=True)
+            return None
+        if len(not_done) > 0 and progress is not None:
+            progress(list(results), list(cached))
+    executor.shutdown(wait=False, cancel_futures=True)
+    for future in not_done:
+        results[futures.index(future)] = TimeoutError(f"No answer from ERDDAP in {timeout} seconds")
+    return results
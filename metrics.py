@@ -0,0 +1,132 @@
+import json
+import os
+import timeit
+
+import constants
+import redis_cache
+
+# Phase timings for the callbacks, as Prometheus histograms. A callback starts a timer and marks
+# the end of each phase (db_read, erddap_fetch, parse, decimate, figure_build, ...); a phase that
+# is marked more than once, say once per dataset, adds up. When the callback is done the phases
+# and the total go to Redis in one pipeline, so the gunicorn workers and the celery workers that
+# run the plots all land in the same histograms. /metrics renders them along with the database
+# pool counters that each process leaves in Redis.
+
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+metrics_enabled = os.environ.get("METRICS", "true").lower() in ("1", "true", "yes")
+# A process's pool counters disappear from /metrics this long after its last callback.
+pool_stats_seconds = int(os.environ.get("METRICS_POOL_SECONDS", 300))
+
+
+def timer(callback):
+    now = timeit.default_timer()
+    return {"callback": callback, "start": now, "last": now, "phases": {}}
+
+
+def lap(t, phase):
+    # Everything since the previous lap (or the start) is charged to phase.
+    now = timeit.default_timer()
+    t["phases"][phase] = t["phases"].get(phase, 0.0) + now - t["last"]
+    t["last"] = now
+
+
+def bucket_label(seconds):
+    for le in buckets:
+        if seconds <= le:
+            return str(le)
+    return "+Inf"
+
+
+def _series(callback, phase):
+    return callback + "|" + phase
+
+
+def done(t):
+    t["phases"]["total"] = timeit.default_timer() - t["start"]
+    if not metrics_enabled:
+        return t["phases"]
+
+    def record(client):
+        pipe = client.pipeline(transaction=False)
+        for phase, seconds in t["phases"].items():
+            series = _series(t["callback"], phase)
+            key = redis_cache.make_key("metrics", "hist", series)
+            pipe.sadd(redis_cache.make_key("metrics", "series"), series)
+            pipe.hincrby(key, bucket_label(seconds), 1)
+            pipe.hincrby(key, "count", 1)
+            pipe.hincrbyfloat(key, "sum", seconds)
+        stats = constants.pool_stats()
+        stats.pop("status")
+        pipe.set(
+            redis_cache.make_key("metrics", "pool", os.getpid()),
+            json.dumps(stats),
+            ex=pool_stats_seconds,
+        )
+        pipe.execute()
+
+    redis_cache.run(record)
+    return t["phases"]
+
+
+def _labels(labels):
+    return "{" + ",".join([f'{name}="{value}"' for name, value in labels.items()]) + "}"
+
+
+def read_histograms(client):
+    histograms = {}
+    members = sorted(m.decode() for m in client.smembers(redis_cache.make_key("metrics", "series")))
+    pipe = client.pipeline(transaction=False)
+    for series in members:
+        pipe.hgetall(redis_cache.make_key("metrics", "hist", series))
+    for series, fields in zip(members, pipe.execute()):
+        histograms[series] = {k.decode(): v.decode() for k, v in fields.items()}
+    return histograms
+
+
+def read_pools(client):
+    pools = {}
+    keys = list(client.scan_iter(match=redis_cache.make_key("metrics", "pool", "*")))
+    values = client.mget(keys) if len(keys) > 0 else []
+    for key, value in zip(keys, values):
+        if value is not None:
+            pools[key.decode().rsplit(":", 1)[1]] = json.loads(value)
+    return pools
+
+
+def render():
+    lines = [
+        "# HELP flux_phase_seconds Time spent in each phase of the dashboard callbacks.",
+        "# TYPE flux_phase_seconds histogram",
+    ]
+    for series, fields in redis_cache.run(read_histograms, {}).items():
+        callback, phase = series.split("|", 1)
+        labels = {"callback": callback, "phase": phase}
+        cumulative = 0
+        for le in [str(b) for b in buckets] + ["+Inf"]:
+            cumulative = cumulative + int(fields.get(le, 0))
+            lines.append("flux_phase_seconds_bucket" + _labels({**labels, "le": le}) + f" {cumulative}")
+        lines.append("flux_phase_seconds_sum" + _labels(labels) + " " + fields.get("sum", "0"))
+        lines.append("flux_phase_seconds_count" + _labels(labels) + " " + fields.get("count", "0"))
+
+    # The pool counters of every process that has run a callback lately, this one included.
+    pools = redis_cache.run(read_pools, {})
+    local = constants.pool_stats()
+    pools[str(local["pid"])] = local
+    counters = [
+        ("connects", "counter", "Database connections opened."),
+        ("connect_seconds", "counter", "Seconds spent opening database connections."),
+        ("checkouts", "counter", "Connections checked out of the pool."),
+        ("queries", "counter", "Statements executed."),
+        ("query_seconds", "counter", "Seconds spent executing statements."),
+    ]
+    for name, kind, help_text in counters:
+        lines.append(f"# HELP flux_db_{name}_total {help_text}")
+        lines.append(f"# TYPE flux_db_{name}_total {kind}")
+        for pid in sorted(pools):
+            labels = {"pid": pid, "pool": pools[pid].get("pool", "")}
+            lines.append(f"flux_db_{name}_total" + _labels(labels) + f" {pools[pid].get(name, 0)}")
+    if "checked_out" in local:
+        lines.append("# HELP flux_db_checked_out Connections checked out of this process's pool right now.")
+        lines.append("# TYPE flux_db_checked_out gauge")
+        lines.append("flux_db_checked_out" + _labels({"pid": local["pid"]}) + f" {local['checked_out']}")
+    return "\n".join(lines) + "\n"
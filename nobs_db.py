@@ -0,0 +1,411 @@
+import argparse
+import json
+import os
+import re
+import time
+import urllib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect, text
+
+import constants
+import erddap_cache
+import snapshot
+from sdig.erddap.info import Info
+
+# Builds the database tables that drive the "discover" part of the dashboard. This is the code
+# from make_nobs_db.ipynb so that it can run unattended, from the command line or from celery beat.
+#
+# The nobs_<SHORT_NAMES> tables hold the monthly number of observations of each variable at each
+# site. A full build reads them from scratch. An update only asks ERDDAP for the months from the
+# last month already in the table for each (dataset, site) on and replaces those rows, since the
+# last month may have been partial when it was read. The other tables are small and are always
+# rebuilt. Either way the build_info version stamp is written last so the app reloads its caches,
+# together with the startup snapshot (snapshot.py) the app boots from.
+#
+#   python nobs_db.py            update the nobs tables and rebuild the rest
+#   python nobs_db.py --full     rebuild everything from scratch
+#   python nobs_db.py --migrate  only add missing indexes to the tables already there
+
+platform_file = "oceansites_flux_list.json"
+
+# How many data sets are counted at the same time, and how hard to retry a failed ERDDAP request.
+harvest_workers = int(os.environ.get("HARVEST_WORKERS", 4))
+harvest_retries = int(os.environ.get("HARVEST_RETRIES", 3))
+harvest_backoff = float(os.environ.get("HARVEST_BACKOFF", 2.0))
+# An update leaves out the sites whose last counted month is this many days before the end of
+# their data set's time coverage: the deployment is over. --full counts them again.
+finished_days = int(os.environ.get("HARVEST_FINISHED_DAYS", 365))
+
+# to_sql(if_exists="replace") drops a table's indexes with the table, so they are created again in
+# the same transaction as every load. The nobs tables are filtered on time (a BRIN index is tiny
+# since rows arrive in time order per site) and updated per site from a month on, and discovery is
+# looked up by site and question. (name suffix, columns, method)
+nobs_indexes = [("site_code_time_idx", ["site_code", "time"], "btree"), ("time_brin", ["time"], "brin")]
+table_indexes = {"discovery": [("site_code_question_id_idx", ["site_code", "question_id"], "btree")]}
+
+
+def load_platforms(path=platform_file):
+    with open(path) as platform_stream:
+        return json.load(platform_stream)
+
+
+def high_water_marks(table):
+    # The last month already counted for each (did, site_code), empty when the table is new.
+    with constants.postgres_engine.connect() as conn:
+        if not inspect(conn).has_table(table):
+            return {}
+        marks = pd.read_sql(
+            f'SELECT did, site_code, MAX(time) AS last_month FROM "{table}" GROUP BY did, site_code',
+            con=conn,
+        )
+    return {(row["did"], str(row["site_code"])): row["last_month"] for row in marks.to_dict(orient="records")}
+
+
+def indexes_for(table):
+    if table.startswith("nobs_"):
+        return nobs_indexes
+    return table_indexes.get(table, [])
+
+
+def create_indexes(conn, table):
+    # Missing indexes only, then fresh planner statistics. BRIN is Postgres only, so the SQLite
+    # databases of the benchmarks get just the b-tree ones.
+    postgres = conn.dialect.name == "postgresql"
+    for suffix, columns, method in indexes_for(table):
+        if method != "btree" and not postgres:
+            continue
+        using = f" USING {method}" if postgres else ""
+        column_list = ", ".join(['"' + column + '"' for column in columns])
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{table}_{suffix}" ON "{table}"{using} ({column_list})'))
+    conn.execute(text(f'ANALYZE "{table}"'))
+
+
+def ensure_indexes():
+    # For a database built before the indexes existed, or after a table was replaced by hand.
+    with constants.postgres_engine.begin() as conn:
+        tables = [table for table in inspect(conn).get_table_names() if len(indexes_for(table)) > 0]
+        for table in tables:
+            create_indexes(conn, table)
+    return tables
+
+
+def read_with_retries(url):
+    # ERDDAP is sometimes busy or restarting, try again with exponential backoff before giving up.
+    for attempt in range(harvest_retries + 1):
+        try:
+            return erddap_cache.read_erddap_csv(url)
+        except Exception as e:
+            if attempt == harvest_retries:
+                raise
+            wait = harvest_backoff * 2**attempt
+            print(f"Retrying {url} in {wait} seconds after {e!r}")
+            time.sleep(wait)
+
+
+def count_url(source, short_names, constraint):
+    to_get = ",".join(short_names)
+    con = urllib.parse.quote(f'{constraint}&orderByCount("site_code,wmo_platform_code,time/1month")')
+    return f"{source}.csv?{to_get},time,wmo_platform_code,site_code{con}"
+
+
+def read_site_counts(source, short_names, sites, marks, did):
+    # One request per site, for data sets where the grouped request is refused.
+    frames = []
+    for site in sites:
+        since = ""
+        if (did, site) in marks:
+            since = f"&time>={marks[(did, site)]}"
+        df = read_with_retries(count_url(source, short_names, f'&site_code="{site}"{since}'))
+        if df is not None:
+            frames.append(df)
+    if len(frames) == 0:
+        return None
+    return pd.concat(frames)
+
+
+def as_utc(value):
+    stamp = pd.Timestamp(value)
+    return stamp.tz_localize("UTC") if stamp.tzinfo is None else stamp.tz_convert("UTC")
+
+
+def coverage_end(source):
+    # time_coverage_end of the data set, None when its info page can not be read.
+    try:
+        end_seconds = Info(constants.erddap_url(source)).get_times()[3]
+        return pd.Timestamp(float(end_seconds), unit="s", tz="UTC")
+    except Exception as e:
+        print(f"Unable to read the time coverage of {source} ({e!r}), updating all of its sites")
+        return None
+
+
+def site_constraint(sites):
+    return '&site_code=~"' + "|".join([re.escape(site) for site in sites]) + '"'
+
+
+def read_counts(source, short_names, marks):
+    did = source[source.rindex("/") + 1:]
+    site_df = read_with_retries(source + ".csv?site_code&distinct()")
+    sites = [str(site) for site in site_df["site_code"]]
+    # Sites without counts are read from the start. The others only need the months from their
+    # high water mark on, so the sites that share a mark share a request, unless the deployment
+    # ended long before the data set does.
+    new_sites = [site for site in sites if (did, site) not in marks]
+    by_mark = {}
+    if len(new_sites) < len(sites):
+        end = coverage_end(source)
+        for site in sites:
+            if (did, site) not in marks:
+                continue
+            mark = marks[(did, site)]
+            if end is not None and as_utc(mark) < end - pd.Timedelta(days=finished_days):
+                continue
+            by_mark.setdefault(mark, []).append(site)
+    updated = [(did, site) for mark in by_mark for site in by_mark[mark]]
+    groups = [(new_sites, "")] + [(by_mark[mark], f"&time>={mark}") for mark in by_mark]
+    frames = []
+    for group, since in groups:
+        if len(group) == 0:
+            continue
+        constraint = since if len(group) == len(sites) else site_constraint(group) + since
+        try:
+            # All the sites of the group in one orderByCount request.
+            df = read_with_retries(count_url(source, short_names, constraint))
+        except Exception as e:
+            print(f"Grouped count of {did} failed ({e!r}), counting one site at a time")
+            df = read_site_counts(source, short_names, group, marks, did)
+        if df is not None:
+            frames.append(df)
+    if len(frames) == 0:
+        return None, updated
+    counts = pd.concat(frames)
+    counts["site_code"] = counts["site_code"].astype(str)
+    if len(updated) > 0:
+        last_month = counts["site_code"].map(lambda site: marks.get((did, site), ""))
+        counts = counts.loc[counts["time"] >= last_month]
+    counts["did"] = did
+    return counts, updated
+
+
+def write_nobs_table(table, frames, updated, marks, full):
+    d0 = pd.concat(frames)
+    with constants.postgres_engine.begin() as conn:
+        if full or len(marks) == 0:
+            d0.to_sql(table, index=False, con=conn, if_exists="replace")
+        else:
+            # Upsert: drop the months being replaced (from each high water mark on) and append.
+            for did, site in updated:
+                conn.execute(
+                    text(f'DELETE FROM "{table}" WHERE did = :did AND site_code = :site AND time >= :last_month'),
+                    {"did": did, "site": site, "last_month": marks[(did, site)]},
+                )
+            d0.to_sql(table, index=False, con=conn, if_exists="append")
+        create_indexes(conn, table)
+    return d0
+
+
+def harvest(searches, full=False):
+    # Every (search, data set) pair is read on a bounded pool of threads, the frames for each table
+    # are collected in a list and concatenated once when they are all in.
+    tables = {}
+    with ThreadPoolExecutor(max_workers=harvest_workers) as executor:
+        for search in searches:
+            table = "nobs_" + "_".join(search["short_names"])
+            marks = {}
+            if not full:
+                marks = high_water_marks(table)
+            futures = [executor.submit(read_counts, source, search["short_names"], marks) for source in search["datasets"]]
+            tables[table] = {"marks": marks, "futures": futures}
+        results = {}
+        for table in tables:
+            frames = []
+            updated = []
+            for future in tables[table]["futures"]:
+                df, from_marks = future.result()
+                updated = updated + from_marks
+                if df is not None:
+                    frames.append(df)
+            if len(frames) > 0:
+                results[table] = write_nobs_table(table, frames, updated, tables[table]["marks"], full)
+            else:
+                results[table] = None
+    return results
+
+
+def update_nobs_table(search, full=False):
+    return harvest([search], full)["nobs_" + "_".join(search["short_names"])]
+
+
+def build_nobs_tables(discovery_json, full=False):
+    discovery = discovery_json["discovery"]
+    searches = []
+    for q in discovery:
+        for search in discovery[q]["search"]:
+            if search not in searches:
+                searches.append(search)
+    results = harvest(searches, full)
+    for table in results:
+        print(table, 0 if results[table] is None else results[table].shape[0], "rows read")
+    return results
+
+
+def read_platforms(platform_json):
+    variables_by_did = {}
+    units_by_did = {}
+    metadata_by_did = {}
+    loc_df = None
+    plats = platform_json["config"]["datasets"]
+    for dataset in plats:
+        url = dataset["url"]
+        locations_url = dataset["locations"]
+        did = url[url.rindex("/") + 1:]
+        dataset["id"] = did
+        info = Info(constants.erddap_url(url))
+        title = info.get_title()
+        dataset["title"] = title
+        start_date, end_date, start_date_seconds, end_date_seconds = info.get_times()
+        dataset["start_date"] = start_date
+        dataset["end_date"] = end_date
+        dataset["start_date_seconds"] = start_date_seconds
+        dataset["end_date_seconds"] = end_date_seconds
+        variables_list, long_names, units, standard_names, d_types = info.get_variables()
+        units_by_did[did] = units
+        variables_by_did[did] = variables_list
+        metadata_by_did[did] = dataset
+        mdf = pd.read_csv(constants.erddap_url(locations_url), skiprows=[1],
+                          dtype={"wmo_platform_code": str, "site_code": str, "latitude": np.float64, "longitude": np.float64})
+        if mdf.shape[0] > 1 and mdf.site_code.nunique() <= 1:
+            # Several deployments at slightly different positions, use the mean location.
+            adf = mdf.mean(axis=0, numeric_only=True)
+            adf["site_code"] = mdf["site_code"].iloc[0]
+            adf["wmo_platform_code"] = mdf["wmo_platform_code"].iloc[0]
+            mdf = pd.DataFrame(columns=["latitude", "longitude", "site_code", "wmo_platform_code"], index=[0], )
+            mdf["latitude"] = adf.loc["latitude"]
+            mdf["longitude"] = adf.loc["longitude"]
+            mdf["site_code"] = adf.loc["site_code"]
+        if loc_df is None:
+            loc_df = mdf
+        else:
+            loc_df = pd.concat([loc_df, mdf])
+    return loc_df, metadata_by_did, units_by_did, variables_by_did
+
+
+def build_locations(loc_df):
+    loc_df = loc_df.drop_duplicates()
+    with constants.postgres_engine.begin() as conn:
+        loc_df.to_sql("locations", index=False, con=conn, if_exists="replace")
+    return loc_df
+
+
+def build_metadata(metadata_by_did):
+    ddf = pd.DataFrame.from_dict(metadata_by_did, orient="index")
+    with constants.postgres_engine.begin() as conn:
+        ddf.to_sql("metadata", index=False, con=conn, if_exists="replace")
+    return ddf
+
+
+def build_units(units_by_did):
+    udf = pd.DataFrame.from_dict(units_by_did, orient="index")
+    udf = udf.reset_index().rename(columns={"index": "did"})
+    with constants.postgres_engine.begin() as conn:
+        udf.to_sql("units", index=False, if_exists="replace", con=conn)
+    return udf
+
+
+def build_discovery(discovery_json):
+    discovery_df = None
+    query = "site_code&distinct()"
+    for discovery_id in discovery_json["discovery"]:
+        question = discovery_json["discovery"][discovery_id]
+        for collection in question["search"]:
+            short_string = ",".join(collection["short_names"])
+            for url in collection["datasets"]:
+                did = url[url.rfind("/") + 1:]
+                r_url = url + ".csv?" + query
+                df = pd.read_csv(constants.erddap_url(r_url), skiprows=[1])
+                df["question_id"] = discovery_id
+                df["question_title"] = question["question"]
+                df["short_string"] = short_string
+                df["did"] = did
+                if discovery_df is None:
+                    discovery_df = df
+                else:
+                    discovery_df = pd.concat([discovery_df, df])
+    with constants.postgres_engine.begin() as conn:
+        discovery_df.to_sql("discovery", index=False, if_exists="replace", con=conn)
+        create_indexes(conn, "discovery")
+    return discovery_df
+
+
+def build_variables(variables_by_did):
+    unroll = []
+    for did in variables_by_did:
+        for short_name in variables_by_did[did]:
+            unroll.append({"did": did, "short_name": short_name})
+    vdf = pd.DataFrame(unroll)
+    with constants.postgres_engine.begin() as conn:
+        vdf.to_sql("variables", index=False, if_exists="replace", con=conn)
+    return vdf
+
+
+def build_reference_tables(platform_json, discovery_json):
+    loc_df, metadata_by_did, units_by_did, variables_by_did = read_platforms(platform_json)
+    return {
+        "locations": build_locations(loc_df),
+        "metadata": build_metadata(metadata_by_did),
+        "units": build_units(units_by_did),
+        "discovery": build_discovery(discovery_json),
+        "variables": build_variables(variables_by_did),
+    }
+
+
+def write_build_info(discovery_json=None):
+    # Stamp the build so running apps drop their cached copies of these tables. The startup
+    # snapshot goes with the stamp, and to SNAPSHOT_FILE for workers started on this machine.
+    now = pd.Timestamp.now(tz="UTC")
+    version = now.strftime("%Y%m%dT%H%M%S.%fZ")
+    startup = snapshot.make_snapshot(version, snapshot.load_discovery() if discovery_json is None else discovery_json)
+    build_df = pd.DataFrame([{"version": version, "built_at": now.isoformat(), "snapshot": json.dumps(startup)}])
+    with constants.postgres_engine.begin() as conn:
+        build_df.to_sql("build_info", index=False, if_exists="replace", con=conn)
+    try:
+        snapshot.write_file(startup)
+    except OSError as e:
+        # The apps still find the snapshot with the stamp.
+        print(f"Unable to save the startup snapshot to {snapshot.snapshot_file}: {e}")
+    return build_df
+
+
+def build(full=False, reference=True):
+    discovery_json = snapshot.load_discovery()
+    build_nobs_tables(discovery_json, full)
+    if reference:
+        build_reference_tables(load_platforms(), discovery_json)
+    return write_build_info(discovery_json)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or update the flux discovery database.")
+    parser.add_argument("--full", action="store_true", help="re-harvest every nobs table from scratch")
+    parser.add_argument(
+        "--nobs-only",
+        action="store_true",
+        help="only update the nobs tables, leave locations, metadata, units, discovery and variables alone",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="only create the missing indexes and refresh the table statistics, read nothing from ERDDAP",
+    )
+    args = parser.parse_args(argv)
+    if args.migrate:
+        print("Indexed", ", ".join(ensure_indexes()))
+        return
+    build_df = build(full=args.full, reference=not args.nobs_only)
+    print("Wrote build", build_df["version"].values[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,555 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import plotly.colors
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+from dash import callback, exceptions, Input, Output, State
+
+import decimate
+import erddap_cache
+import metrics
+import profiling
+import redis_cache
+import refdata
+import tasks
+
+# The plot of the selected platform. It is a background callback registered with dash.callback
+# rather than on the app, so the celery workers can load it through worker.py without importing
+# app.py and with it the layout, the design kit and grid components and the page callbacks.
+
+height_of_row = 450
+legend_gap = height_of_row
+line_rgb = "rgba(.04,.04,.04,.2)"
+plot_bg = "rgba(1.0, 1.0, 1.0 ,1.0)"
+
+sub_sample_limit = 88000
+# Points per variable are plot_point_budget / (subplots x variables), but never below
+# min_points_per_variable. The default keeps the old limit for a single two variable plot.
+plot_point_budget = int(os.environ.get("PLOT_POINT_BUDGET", 2 * sub_sample_limit))
+min_points_per_variable = 2000
+decimate_mode = os.environ.get("DECIMATE_MODE", "minmax")
+
+# Each plot request gets the next number of its browser session from stamp_plot_request, in the
+# web process, before the task is queued. The task drops itself without plotting once its session
+# has a bigger number: when it starts, if it sat in the queue behind a newer click, and while it
+# waits on ERDDAP. Dash also revokes the job the browser replaces, but a revoke is a broadcast
+# that a busy or restarting worker can miss; this check frees the worker slot either way, and the
+# fetches it leaves running still end up in the cache. Without Redis nothing is superseded.
+plot_request_seconds = 24 * 60 * 60
+
+# A plot that takes a while is shown in steps while its datasets are read: the datasets read so
+# far, with the ones still waiting drawn from whatever the disk cache has for the range. The steps
+# have at most preview_points_per_variable points per variable, so they are cheap to build and
+# send, and they come no closer together than the renderer polls for them (progress_seconds), so
+# a plot that is done within that time costs nothing extra. The finished plot has the full budget.
+preview_points_per_variable = 1000
+progress_seconds = 1.0
+
+y_pos_1_4 = [0.999, 0.73225, 0.447, 0.161]
+t_pos_1_4 = [0.0005, 0.0005, 0.018, 0.036]
+x_pos_1_4 = [0.1, 0.01, 0.01, 0.01]
+
+y_pos_2 = [0.999, 0.3792]
+t_pos_2 = [0.0005, 0.048]
+x_pos_2 = [0.095, 0.011]
+
+color_discrete_map={
+    "TAUX": "#636EFA",  # plotly graph obejcts default discrete colors [0] blue-ish 
+    "TAUY": "#EF553B",  # plotly graph objects default discrete colors [1] red-ish
+    'QNET': '#636EFA', 
+    'QLAT': '#636EFA', 
+    'QSEN': '#EF553B', 
+    'RAIN':'#636EFA', 
+    'EVAP': '#EF553B', 
+    'QL':'#636EFA', 
+    'QS': '#EF553B', 
+    'QN': '#636EFA'
+}
+
+
+def get_blank(message):
+
+    blank_graph = go.Figure(go.Scatter(x=[0, 1], y=[0, 1], showlegend=False))
+    blank_graph.add_trace(go.Scatter(x=[0, 1], y=[0, 1], showlegend=False))
+    blank_graph.update_traces(visible=False)
+    blank_graph.update_layout(
+        xaxis={"visible": False},
+        yaxis={"visible": False},
+        title=message,
+        plot_bgcolor=plot_bg,
+        annotations=[
+            {
+                "text": message,
+                "xref": "paper",
+                "yref": "paper",
+                "showarrow": False,
+                "font": {"size": 14},
+            },
+        ],
+    )
+    return blank_graph
+
+
+def make_gaps(pdf, fre):
+    if pdf.shape[0] > 3:
+        # This magic inserts missing values between rows that are more than two deltas apart.
+        # Make time the index to the data
+        pdf2 = pdf.set_index("time")
+        pdf2 = pdf2[~pdf2.index.duplicated()]
+        # make a index at the expected delta
+        fill_dates = pd.date_range(pdf["time"].iloc[0], pdf["time"].iloc[-1], freq=fre)
+        # sprinkle the actual values out along the new time axis, by combining the regular
+        # intervals index and the data index
+        all_dates = fill_dates.append(pdf2.index)
+        all_dates = all_dates[~all_dates.duplicated()]
+        fill_sort = sorted(all_dates)
+        # reindex the data which causes NaNs everywhere in the regular index that don't
+        # exactly match the data, with the data in between the NaNs
+        pdf3 = pdf2.reindex(fill_sort)
+        # remove the NaN rows that are by themselves because there is data near enough
+        mask1 = ~pdf3["site_code"].notna() & ~pdf3["site_code"].shift().notna()
+        mask2 = pdf3["site_code"].notna()
+        pdf4 = pdf3[mask1 | mask2]
+        # Reindex to 0 ... N
+        pdf = pdf4.reset_index()
+    return pdf
+
+
+def plot_request_key(session_id):
+    return redis_cache.make_key("plot-request", session_id)
+
+
+def superseded(plot_request):
+    if plot_request is None or plot_request.get("seq") is None:
+        return False
+    latest = redis_cache.run(lambda client: client.get(plot_request_key(plot_request["session"])))
+    return latest is not None and int(latest) > plot_request["seq"]
+
+
+@callback(
+    Output("plot-request", "data"),
+    [
+        Input("selected-platform", "data"),
+        Input("start-date", "value"),
+        Input("end-date", "value"),
+        Input("active-platforms", "data"),
+    ],
+    [
+        State("session-id", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def stamp_plot_request(selection_data, plot_start_date, plot_end_date, active_platforms, session_id):
+    def next_seq(client):
+        key = plot_request_key(session_id)
+        pipe = client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, plot_request_seconds)
+        return pipe.execute()[0]
+
+    seq = None if session_id is None else redis_cache.run(next_seq)
+    # requested keeps the stamps apart when there is no sequence number.
+    return {"session": session_id, "seq": seq, "requested": time.time()}
+
+
+def build_figure(to_plot, fetches, frames, selected_platform, plot_start_date, plot_end_date, timer, pending=()):
+    # The figure, download links, trace list and card title for the datasets in to_plot, read into
+    # frames (a frame, or the exception that stopped the read). The datasets whose index is in
+    # pending are still being read: their frame is what the cache already had, or None. While any
+    # are pending the figure is a preview with at most preview_points_per_variable points.
+    num_rows = len(to_plot)
+    dids = [row["did"] for row in to_plot]
+    plot_time = "&time>=" + plot_start_date + "&time<=" + plot_end_date
+    download_grid = []
+    plot_title = ""
+    figure = make_subplots(
+        rows=num_rows,
+        cols=1,
+        row_heights=[450] * num_rows,
+        shared_xaxes="all",
+        shared_yaxes=False,
+        subplot_titles=dids,
+        vertical_spacing=(0.275 / num_rows),
+    )
+    dataset_idx = 0
+    sub_plot_titles = []
+    sub_title_xpos = []
+    sub_plot_bottom_titles = []
+    if len(dids) == 2:
+        y_pos = y_pos_2.copy()
+        t_pos = t_pos_2.copy()
+        x_pos = x_pos_2.copy()
+    else:
+        y_pos = y_pos_1_4.copy()
+        t_pos = t_pos_1_4.copy()
+        x_pos = x_pos_1_4.copy()
+    metrics.lap(timer, "subplot_setup")
+
+    plot_traces = []
+    for (
+        dataset_idx,
+        row,
+    ) in enumerate(to_plot):  # it has at most four rows. Don't panic.
+        grid_row = {}
+        dataset_idx = dataset_idx + 1
+        p_did = row["did"]
+        current_dataset = refdata.metadata(p_did)
+        units = refdata.units(p_did)
+        metrics.lap(timer, "db_read")
+        p_url = str(current_dataset["url"].values[0])
+        short_string = row["short_string"]
+        pvars = short_string + ",site_code,time"
+        p_url = (
+            p_url
+            + ".csv?"
+            + pvars
+            + plot_time
+            + '&site_code="'
+            + selected_platform
+            + '"'
+        )
+        if len(pending) == 0:
+            print("Making a plot of " + p_url)
+        plot_title = "Plot of " + short_string + " at " + selected_platform
+        df = frames[dataset_idx - 1]
+        sub_title = selected_platform
+        if isinstance(df, Exception):
+            if len(pending) == 0:
+                print("Unable to read " + p_url + " " + repr(df))
+            df = pd.DataFrame(columns=short_string.split(",") + ["site_code", "time"])
+            sub_title = sub_title + " (data request failed) "
+        elif df is None:
+            df = pd.DataFrame(columns=short_string.split(",") + ["site_code", "time"])
+            sub_title = sub_title + " (loading) "
+        bottom_title = current_dataset["title"].astype(str).values[0]
+        vlist = short_string.split(",")
+        points_per_variable = max(
+            min_points_per_variable, plot_point_budget // (num_rows * len(vlist))
+        )
+        if len(pending) > 0:
+            points_per_variable = min(points_per_variable, preview_points_per_variable)
+        if dataset_idx - 1 in pending:
+            if df.shape[0] > 0:
+                sub_title = sub_title + " (loading, showing what is cached) "
+            sub_title_xpos.append(.165)
+        elif df.shape[0] > points_per_variable:
+            sub_title = (
+                sub_title
+                + " (timeseries decimated to "
+                + str(points_per_variable)
+                + " points) "
+            )
+            sub_title_xpos.append(.165)
+        else:
+            sub_title_xpos.append(.045)
+        sub_plot_titles.append(sub_title)
+        sub_plot_bottom_titles.append(bottom_title)
+        l_labels = []
+        for n, v in enumerate(vlist):
+            if v in units:
+                unit = units[v].astype(str).values[0]
+                l_labels.append(v + " (" + unit + ")")
+            else:
+                l_labels.append(v)
+        legend_name = "legend"
+        if dataset_idx > 1:
+            legend_name = "legend" + str(dataset_idx)
+        times = df["time"].values
+        for n, v in enumerate(vlist):
+            values = df[v].to_numpy(dtype=np.float64)
+            metrics.lap(timer, "parse")
+            # Decimated per variable so each one keeps its own peaks and gaps.
+            keep = decimate.decimate(
+                times.astype(np.int64), values, points_per_variable, decimate_mode
+            )
+            metrics.lap(timer, "decimate")
+            # Same look as the px.line traces this replaced.
+            trace_type = go.Scattergl if keep.shape[0] > 1000 else go.Scatter
+            trace = trace_type(
+                x=times[keep],
+                y=values[keep],
+                name=l_labels[n],
+                legendgroup=v,
+                legend=legend_name,
+                mode="lines",
+                line={
+                    "color": color_discrete_map.get(
+                        v, plotly.colors.qualitative.Plotly[n % 10]
+                    )
+                },
+                hovertemplate="variable=" + v + "<br>time=%{x}<br>value=%{y}<extra></extra>",
+            )
+            figure.add_trace(trace, row=dataset_idx, col=1)
+            plot_traces.append(
+                {
+                    "url": fetches[dataset_idx - 1]["url"],
+                    "did": p_did,
+                    "site_code": selected_platform,
+                    "variables": vlist,
+                    "variable": v,
+                    "start": plot_start_date,
+                    "end": plot_end_date,
+                }
+            )
+            metrics.lap(timer, "figure_build")
+
+
+        grid_row['title'] = current_dataset["title"].astype(str).values[0] + " at " + selected_platform
+        grid_row['erddap'] = f'[ERDDAP Data Page]({current_dataset["url"].astype(str).values[0]})'
+        grid_row['html'] = f'[HTML]({p_url.replace(".csv", ".htmlTable")})'
+        grid_row['csv'] =  f'[CSV]({p_url.replace(".htmlTable", ".csv")})'
+        grid_row['netcdf'] = f'[NetCDF]({p_url.replace(".csv", ".ncCF")})'
+        download_grid.append(grid_row)
+        metrics.lap(timer, "parse")
+
+    figure.update_layout(height=height_of_row * num_rows)
+    # Keeps the user's zoom when refine_plot_on_zoom swaps in the detailed data.
+    figure.update_layout(uirevision=plot_start_date + plot_end_date + selected_platform)
+    figure.update_layout(
+        plot_bgcolor=plot_bg,
+        hovermode="x",
+        paper_bgcolor="white",
+        margin=dict(
+            l=80,
+            r=80,
+            b=80,
+            t=80,
+        ),
+    )
+    figure.update_xaxes(
+        {
+            "ticklabelmode": "period",
+            "showticklabels": True,
+            "gridcolor": line_rgb,
+            "zeroline": True,
+            "zerolinecolor": line_rgb,
+            "showline": True,
+            "linewidth": 1,
+            "linecolor": line_rgb,
+            "mirror": True,
+            "tickfont": {"size": 16},
+            "tickformatstops": [
+                dict(dtickrange=[1000, 60000], value="%H:%M:%S\n%d%b%Y"),
+                dict(dtickrange=[60000, 3600000], value="%H:%M\n%d%b%Y"),
+                dict(dtickrange=[3600000, 86400000], value="%H:%M\n%d%b%Y"),
+                dict(dtickrange=[86400000, 604800000], value="%e\n%b %Y"),
+                dict(dtickrange=[604800000, "M1"], value="%b\n%Y"),
+                dict(dtickrange=["M1", "M12"], value="%b\n%Y"),
+                dict(dtickrange=["M12", None], value="%Y"),
+            ],
+        }
+    )
+    figure.update_yaxes(
+        {
+            "gridcolor": line_rgb,
+            "zeroline": True,
+            "zerolinecolor": line_rgb,
+            "showline": True,
+            "linewidth": 1,
+            "linecolor": line_rgb,
+            "mirror": True,
+            "tickfont": {"size": 16},
+        }
+    )
+    # print('y_pos', y_pos)
+    # print('t_pos', t_pos)
+    for l in range(0, len(dids)):
+        legend = "legend"
+        if l > 0:
+            legend = legend + str(l + 1)
+        lgnd = {
+            legend: {
+                "yref": "paper",
+                "y": y_pos[l],
+                "xref": "paper",
+                "x": x_pos[l],
+                "orientation": "v",
+                "bgcolor": "white",
+            }
+        }
+        figure["layout"].update(lgnd)
+        # print('title pos ', y_pos[l] + t_pos[l])
+        figure["layout"]["annotations"][l].update(
+            {
+                "text": sub_plot_titles[l],
+                "x": sub_title_xpos[l],
+                "font_size": 22,
+                "y": y_pos[l] + t_pos[l],
+            }
+        )
+        figure.add_annotation(
+            xref="x domain",
+            yref="y domain",
+            xanchor="right",
+            yanchor="bottom",
+            x=1.0,
+            y=-0.246,
+            font_size=22,
+            text=sub_plot_bottom_titles[l],
+            showarrow=False,
+            row=(l + 1),
+            col=1,
+            bgcolor="rgba(255,255,255,.85)",
+        )
+    return figure, download_grid, plot_traces, plot_title
+
+
+@callback(
+    [
+        Output('download-button', 'disabled'),
+        Output("plot-card-title", "children"),
+        Output("plot-graph", "figure"),
+        Output("download-grid", "rowData"),
+        Output("location", "search"),
+        Output("plot-traces", "data"),
+    ],
+    [
+        Input("plot-request", "data"),
+    ],
+    [
+        State("selected-platform", "data"),
+        State("start-date", "value"),
+        State("end-date", "value"),
+        State("active-platforms", "data"),
+        State("radio-items", "value"),
+    ],
+    prevent_initial_call=True,
+    background=True,
+    manager=tasks.background_callback_manager,
+    progress=[
+        Output("plot-graph", "figure"),
+        Output("plot-card-title", "children"),
+        Output("plot-traces", "data"),
+    ],
+)
+@profiling.profiled
+def plot_from_selected_platform(
+    set_progress,
+    plot_request,
+    selection_data,
+    plot_start_date,
+    plot_end_date,
+    active_platforms,
+    question_choice,
+):
+    timer = metrics.timer("plot_from_selected_platform")
+    if superseded(plot_request):
+        raise exceptions.PreventUpdate
+    if selection_data is not None:
+        selected_json = json.loads(selection_data)
+        if "site_code" in selected_json:
+            selected_platform = selected_json["site_code"]
+        else:
+            raise exceptions.PreventUpdate
+    else:
+        raise exceptions.PreventUpdate
+    if (
+        plot_start_date is None
+        or len(plot_start_date) == 0
+        or plot_end_date is None
+        or len(plot_end_date) == 0
+    ):
+        raise exceptions.PreventUpdate
+
+    plots_df = refdata.discovery(selected_platform, question_choice)
+    metrics.lap(timer, "db_read")
+
+    download_grid = []
+
+    if selected_platform is not None:
+
+        if plots_df.empty:
+            message = (
+                "No data available at "
+                + selected_platform
+                + " for "
+                + plot_start_date
+                + " to "
+                + plot_end_date
+            )
+            metrics.done(timer)
+            return [
+                True,
+                "",
+                get_blank(message),
+                download_grid,
+                "",
+                [],
+            ]
+        # Get list of datasets which contain these site codes for this question
+        to_plot = plots_df.to_dict(orient="records")
+
+        # Fetch every dataset at once so the wait is as long as the slowest one, not the sum.
+        fetches = []
+        for row in to_plot:
+            fetches.append(
+                {
+                    "url": str(refdata.metadata(row["did"])["url"].values[0]),
+                    "did": row["did"],
+                    "site_code": selected_platform,
+                    "variables": row["short_string"].split(","),
+                    "start": plot_start_date,
+                    "end": plot_end_date,
+                }
+            )
+        metrics.lap(timer, "db_read")
+
+        started = time.monotonic()
+        last_published = None
+        last_shown = None
+
+        def progress(results, cached):
+            # The datasets read so far, and the cached rows of the others, once the renderer has
+            # had time to ask and only when there is something new.
+            nonlocal last_published, last_shown
+            now = time.monotonic()
+            if now - started < progress_seconds:
+                return
+            if last_published is not None and now - last_published < progress_seconds:
+                return
+            pending = set(i for i, df in enumerate(results) if df is None)
+            shown = [cached[i] if i in pending else df for i, df in enumerate(results)]
+            state = [(i in pending, df is None) for i, df in enumerate(shown)]
+            if all(df is None for df in shown) or state == last_shown:
+                return
+            last_published = now
+            last_shown = state
+            metrics.lap(timer, "erddap_fetch")
+            figure, _, _, plot_title = build_figure(
+                to_plot, fetches, shown, selected_platform, plot_start_date, plot_end_date, timer, pending
+            )
+            # No traces, so a zoom before the plot is done leaves the preview alone.
+            set_progress([figure, plot_title, []])
+            metrics.lap(timer, "progress")
+
+        frames = erddap_cache.get_many(fetches, give_up=lambda: superseded(plot_request), progress=progress)
+        metrics.lap(timer, "erddap_fetch")
+        if frames is None:
+            raise exceptions.PreventUpdate
+
+        figure, download_grid, plot_traces, plot_title = build_figure(
+            to_plot, fetches, frames, selected_platform, plot_start_date, plot_end_date, timer
+        )
+        query = (
+            "?start_date="
+            + plot_start_date
+            + "&end_date="
+            + plot_end_date
+            + "&q="
+            + question_choice
+        )
+        query = (
+            query
+            + "&site_code="
+            + selected_platform
+            + "&lat="
+            + str(selected_json["lat"])
+        )
+        query = query + "&lon=" + str(selected_json["lon"])
+        metrics.lap(timer, "layout")
+        metrics.done(timer)
+        return [False, plot_title, figure, download_grid, query, plot_traces]
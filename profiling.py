@@ -0,0 +1,108 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import time
+import timeit
+
+from dash import ctx
+
+# Opt-in profiling of the callbacks, for finding out where a slow plot spends its time in
+# production. PROFILE_CALLBACKS names the callbacks to profile (comma separated, or "all"); every
+# call of those runs under cProfile, and the PROFILE_KEEP slowest calls of each callback are kept
+# in PROFILE_DIR as a .prof file (open it with pstats or snakeviz) plus a .json with the inputs,
+# the trigger and the top of the cumulative time listing. The web and celery workers write to the
+# same directory, so background callbacks show up too. Nothing is wrapped when it is not set.
+#
+#   PROFILE_CALLBACKS=plot_from_selected_platform,update_platform_state
+
+profile_callbacks = [name.strip() for name in os.environ.get("PROFILE_CALLBACKS", "").split(",") if name.strip() != ""]
+profile_dir = os.environ.get("PROFILE_DIR", "./profiles")
+profile_keep = int(os.environ.get("PROFILE_KEEP", 10))
+profile_top = 40
+
+
+def enabled(name):
+    return "all" in profile_callbacks or name in profile_callbacks
+
+
+def _saved(name):
+    # (milliseconds, file stem) of the calls kept for this callback, slowest first.
+    saved = []
+    if not os.path.isdir(profile_dir):
+        return saved
+    for file_name in os.listdir(profile_dir):
+        stem, extension = os.path.splitext(file_name)
+        parts = stem.split("--")
+        if extension == ".json" and len(parts) == 4 and parts[0] == name:
+            saved.append((int(parts[1]), stem))
+    return sorted(saved, reverse=True)
+
+
+def _trigger():
+    try:
+        return ctx.triggered_id
+    except Exception:
+        return None
+
+
+def save(name, profile, elapsed, args, kwargs, error):
+    milliseconds = int(elapsed * 1000)
+    saved = _saved(name)
+    if len(saved) >= profile_keep and milliseconds <= saved[profile_keep - 1][0]:
+        return None
+    os.makedirs(profile_dir, exist_ok=True)
+    stem = f"{name}--{milliseconds:09d}--{os.getpid()}--{int(time.time() * 1000)}"
+    profile.dump_stats(os.path.join(profile_dir, stem + ".prof"))
+    listing = io.StringIO()
+    pstats.Stats(profile, stream=listing).sort_stats("cumulative").print_stats(profile_top)
+    record = {
+        "callback": name,
+        "seconds": elapsed,
+        "pid": os.getpid(),
+        "trigger": _trigger(),
+        "args": args,
+        "kwargs": kwargs,
+        "error": error,
+        "top": listing.getvalue().splitlines(),
+    }
+    with open(os.path.join(profile_dir, stem + ".json"), "w") as record_stream:
+        json.dump(record, record_stream, indent=2, default=repr)
+    # Drop what fell out of the slowest PROFILE_KEEP.
+    for milliseconds, old_stem in _saved(name)[profile_keep:]:
+        for extension in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(profile_dir, old_stem + extension))
+            except FileNotFoundError:
+                pass
+    return stem
+
+
+def profiled(func):
+    # Goes between @app.callback and the function so Dash registers the wrapper.
+    name = func.__name__
+    if not enabled(name):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = cProfile.Profile()
+        error = None
+        start = timeit.default_timer()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            profile.disable()
+            elapsed = timeit.default_timer() - start
+            try:
+                save(name, profile, elapsed, list(args), kwargs, error)
+            except OSError as e:
+                print(f"Unable to save the profile of {name}: {e!r}")
+
+    return wrapper
@@ -0,0 +1,63 @@
+import json
+import os
+import timeit
+
+import redis
+
+# Small JSON values shared by every gunicorn and celery worker through the Redis that already
+# carries the celery queue. Redis is only ever a cache here: when it is down or slow the calls
+# return None or do nothing and the caller computes the answer itself. After a failure Redis is
+# left alone for REDIS_RETRY_SECONDS so a dead server does not cost a timeout on every request.
+
+redis_url = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+redis_timeout = float(os.environ.get("REDIS_TIMEOUT", 0.5))
+redis_retry_seconds = float(os.environ.get("REDIS_RETRY_SECONDS", 30))
+key_prefix = os.environ.get("REDIS_KEY_PREFIX", "flux")
+
+_client = None
+_client_pid = None
+_down_until = 0.0
+
+
+def get_redis():
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.Redis.from_url(
+            redis_url,
+            socket_timeout=redis_timeout,
+            socket_connect_timeout=redis_timeout,
+        )
+        _client_pid = os.getpid()
+    return _client
+
+
+def make_key(*parts):
+    return ":".join([key_prefix] + [str(part) for part in parts])
+
+
+def _failed(e):
+    global _down_until
+    _down_until = timeit.default_timer() + redis_retry_seconds
+    print(f"Redis unavailable ({e!r}), not using it for {redis_retry_seconds} seconds")
+
+
+def run(work, default=None):
+    # Calls work(client) and returns its result, or default when Redis is unavailable.
+    if timeit.default_timer() < _down_until:
+        return default
+    try:
+        return work(get_redis())
+    except redis.exceptions.RedisError as e:
+        _failed(e)
+        return default
+
+
+def get_json(key):
+    value = run(lambda client: client.get(key))
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+def set_json(key, value, seconds):
+    run(lambda client: client.set(key, json.dumps(value), ex=int(seconds)))
@@ -0,0 +1,99 @@
+import os
+import timeit
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+import constants
+
+# The locations, metadata, units and discovery tables only change when make_nobs_db rebuilds the
+# database, so each process keeps a copy, indexed the way the callbacks look them up. The build
+# writes a version stamp to the build_info table; the copy is thrown away when the stamp changes.
+# The stamp itself is checked at most every REFDATA_CHECK_SECONDS.
+
+check_seconds = float(os.environ.get("REFDATA_CHECK_SECONDS", 60))
+
+_tables = None
+_tables_pid = None
+_version = None
+_checked = None
+_checked_pid = None
+
+
+def read_build_version():
+    try:
+        with constants.postgres_engine.connect() as conn:
+            stamp = conn.execute(text("SELECT version FROM build_info")).scalar()
+    except SQLAlchemyError:
+        # A database built before the stamp existed, never invalidate.
+        return None
+    if stamp is None:
+        return None
+    return str(stamp)
+
+
+def build_version():
+    global _version, _checked, _checked_pid
+    now = timeit.default_timer()
+    if _checked is None or _checked_pid != os.getpid() or now - _checked > check_seconds:
+        _version = read_build_version()
+        _checked = now
+        _checked_pid = os.getpid()
+    return _version
+
+
+def _group(df, by):
+    return {key: group.reset_index(drop=True) for key, group in df.groupby(by)}
+
+
+def load_tables():
+    with constants.postgres_engine.connect() as conn:
+        # The platform stores hold row numbers into this frame, computed by one worker and read by
+        # another, so every process needs the rows in the same order.
+        locations = pd.read_sql("SELECT * from locations ORDER BY site_code, latitude, longitude", con=conn)
+        metadata = pd.read_sql("SELECT * from metadata", con=conn)
+        units = pd.read_sql("SELECT * from units", con=conn)
+        discovery = pd.read_sql("SELECT * from discovery ORDER BY did", con=conn)
+    return {
+        "locations": locations,
+        "metadata": metadata.iloc[0:0],
+        "metadata_by_did": _group(metadata, "id"),
+        "units": units.iloc[0:0],
+        "units_by_did": _group(units, "did"),
+        "discovery": discovery.iloc[0:0],
+        "discovery_by_site": _group(discovery, ["site_code", "question_id"]),
+    }
+
+
+def get_tables():
+    global _tables, _tables_pid
+    version = build_version()
+    if _tables is None or _tables_pid != os.getpid() or _tables["version"] != version:
+        _tables = load_tables()
+        _tables["version"] = version
+        _tables_pid = os.getpid()
+    return _tables
+
+
+# Each accessor hands back a copy in the same shape as the SELECT it replaces, so callers are free
+# to add columns without touching the cached frames.
+
+
+def locations():
+    return get_tables()["locations"].copy()
+
+
+def metadata(did):
+    tables = get_tables()
+    return tables["metadata_by_did"].get(did, tables["metadata"]).copy()
+
+
+def units(did):
+    tables = get_tables()
+    return tables["units_by_did"].get(did, tables["units"]).copy()
+
+
+def discovery(site_code, question_id):
+    tables = get_tables()
+    return tables["discovery_by_site"].get((site_code, question_id), tables["discovery"]).copy()
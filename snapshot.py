@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+import constants
+import refdata
+from sdig.erddap.info import Info
+
+# What the app needs before it can build its layout: the overall time range of the data sets, the
+# slider marks for it and the discovery questions. nobs_db.py computes them at the end of a build
+# and saves them with the build_info stamp and in SNAPSHOT_FILE, so a worker starts by reading one
+# small file instead of querying Postgres. Without the file the stamp's copy is used, and a
+# database built before snapshots existed is queried the old way. Afterwards get() compares the
+# snapshot with the build stamp (at most every REFDATA_CHECK_SECONDS, see refdata.py) and reloads
+# it in a background thread when a new build has been stamped, serving the old one meanwhile.
+
+snapshot_file = os.environ.get("SNAPSHOT_FILE", "startup_snapshot.json")
+discovery_file = "flux_discovery.json"
+
+_snapshot = None
+_refreshing = None
+_lock = threading.Lock()
+
+
+def load_discovery(path=discovery_file):
+    with open(path) as discovery_stream:
+        return json.load(discovery_stream)
+
+
+def radio_options(discovery_json):
+    return [{"label": question["question"], "value": key} for key, question in discovery_json["discovery"].items()]
+
+
+def make_snapshot(version, discovery_json):
+    with constants.postgres_engine.connect() as conn:
+        times = pd.read_sql(
+            "SELECT MIN(start_date_seconds) as mins, MAX(end_date_seconds) maxs, MIN(start_date) as mind, MAX(end_date) as maxd from metadata",
+            con=conn,
+        )
+    start_seconds = float(times["mins"].values[0])
+    end_seconds = float(times["maxs"].values[0])
+    # Mark positions are the keys; JSON keeps them as strings, which is what the slider gets anyway.
+    marks = {str(key): value for key, value in Info.get_time_marks(start_seconds, end_seconds).items()}
+    return {
+        "version": version,
+        "all_start": str(times["mind"].values[0]),
+        "all_end": str(times["maxd"].values[0]),
+        "all_start_seconds": start_seconds,
+        "all_end_seconds": end_seconds,
+        "time_marks": marks,
+        "discovery": discovery_json,
+        "radio_options": radio_options(discovery_json),
+    }
+
+
+def write_file(snapshot, path=None):
+    # Written to the side and renamed so a worker starting up never reads half a file.
+    path = snapshot_file if path is None else path
+    partial = path + f".{os.getpid()}.tmp"
+    with open(partial, "w") as snapshot_stream:
+        json.dump(snapshot, snapshot_stream)
+    os.replace(partial, path)
+
+
+def read_file(path=None):
+    path = snapshot_file if path is None else path
+    try:
+        with open(path) as snapshot_stream:
+            return json.load(snapshot_stream)
+    except (OSError, ValueError):
+        return None
+
+
+def read_stored():
+    # The copy saved with the build stamp.
+    try:
+        with constants.postgres_engine.connect() as conn:
+            stored = conn.execute(text("SELECT snapshot FROM build_info")).scalar()
+    except SQLAlchemyError:
+        # A database built before snapshots existed.
+        return None
+    if stored is None:
+        return None
+    return json.loads(stored)
+
+
+def refresh():
+    # From the database, whatever the file says, and saved for the next worker to start.
+    global _snapshot
+    snapshot = read_stored()
+    if snapshot is None:
+        snapshot = make_snapshot(refdata.read_build_version(), load_discovery())
+    try:
+        write_file(snapshot)
+    except OSError as e:
+        print(f"Unable to save the startup snapshot to {snapshot_file}: {e}")
+    _snapshot = snapshot
+    return snapshot
+
+
+def load():
+    # The snapshot as it is, without asking the database whether it is current.
+    global _snapshot
+    if _snapshot is None:
+        snapshot = read_file()
+        if snapshot is None:
+            return refresh()
+        _snapshot = snapshot
+    return _snapshot
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        refresh()
+    except (SQLAlchemyError, OSError, ValueError) as e:
+        print(f"Unable to refresh the startup snapshot: {e}")
+    finally:
+        with _lock:
+            _refreshing = None
+
+
+def get():
+    global _refreshing
+    snapshot = load()
+    version = refdata.build_version()
+    if version is None or version == snapshot["version"]:
+        return snapshot
+    with _lock:
+        # The pid catches a flag left set by a thread that did not survive a fork.
+        if _refreshing != os.getpid():
+            _refreshing = os.getpid()
+            threading.Thread(target=_refresh_in_background, daemon=True).start()
+    return snapshot
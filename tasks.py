@@ -0,0 +1,42 @@
+import os
+
+import diskcache
+from celery import Celery
+from celery.schedules import crontab
+from dash import CeleryManager, DiskcacheManager
+
+import nobs_db
+
+# The celery app and the background callback manager, shared by app.py, which queues the
+# background callbacks, and worker.py, which runs them, so that neither imports the other.
+
+celery_app = Celery(
+    broker=os.environ.get("REDIS_URL", "redis://127.0.0.1:6379"),
+    backend=os.environ.get("REDIS_URL", "redis://127.0.0.1:6379"),
+)
+
+
+@celery_app.task(name="flux.refresh_nobs_db")
+def refresh_nobs_db():
+    # Brings the nobs tables up to date from their high water marks and rebuilds the small tables.
+    build_df = nobs_db.build()
+    return str(build_df["version"].values[0])
+
+
+# The worker-beat process queues the refresh; NOBS_REFRESH_HOUR is in UTC.
+celery_app.conf.timezone = "UTC"
+celery_app.conf.beat_schedule = {
+    "refresh-nobs-db": {
+        "task": "flux.refresh_nobs_db",
+        "schedule": crontab(minute=0, hour=int(os.environ.get("NOBS_REFRESH_HOUR", 6))),
+    },
+}
+
+if os.environ.get("DASH_ENTERPRISE_ENV") == "WORKSPACE":
+    # For testing...
+    # import diskcache
+    cache = diskcache.Cache("./cache")
+    background_callback_manager = DiskcacheManager(cache)
+else:
+    # For production...
+    background_callback_manager = CeleryManager(celery_app)
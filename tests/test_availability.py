@@ -0,0 +1,79 @@
+import datetime
+import os
+import sys
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import availability
+import constants
+import refdata
+import seed
+
+# The cube has to give the same sites and sums as the aggregate query over the nobs tables for any
+# date range. Both count a month when it starts on or after the start date and before the end
+# date, which is what lets app.month_key round a date inside a month up to the next month start.
+
+
+@pytest.fixture(scope="module")
+def discovery(tmp_path_factory):
+    engine = create_engine("sqlite:///" + str(tmp_path_factory.mktemp("availability") / "nobs.db"))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(constants, "postgres_engine", engine)
+        patch.setattr(availability, "_cube", None)
+        patch.setattr(refdata, "_checked", None)
+        discovery_json, platform_json = seed.load_config()
+        seed.seed(1, discovery_json, platform_json)
+        yield discovery_json["discovery"]
+
+
+def searches(discovery):
+    return [search for question in discovery.values() for search in question["search"]]
+
+
+def same_answer(cube, sql):
+    cube = cube.sort_values("site_code").reset_index(drop=True)
+    sql = sql.sort_values("site_code").reset_index(drop=True)
+    assert list(cube["site_code"]) == list(sql["site_code"])
+    columns = [c for c in cube.columns if c != "site_code"]
+    assert np.allclose(cube[columns].to_numpy(dtype=np.float64), sql[columns].to_numpy(dtype=np.float64))
+
+
+def random_ranges(count):
+    rng = np.random.default_rng(0)
+    first = datetime.datetime(1978, 1, 1)
+    ranges = [(None, None), (None, datetime.datetime(2000, 1, 1)), (datetime.datetime(2000, 1, 1), None)]
+    for _ in range(count):
+        start, end = sorted(first + datetime.timedelta(days=int(days)) for days in rng.integers(0, 50 * 365, size=2))
+        ranges.append((start, end))
+    return ranges
+
+
+def test_cube_matches_sql(discovery):
+    answered = 0
+    for start, end in random_ranges(200):
+        for search in searches(discovery):
+            cube = availability.sites_with_data(discovery, search, start, end)
+            same_answer(cube, availability.sites_with_data_sql(search, start, end))
+            answered += cube.shape[0]
+    assert answered > 0
+
+
+@pytest.mark.parametrize(
+    "start, end, rounded_start, rounded_end",
+    [
+        ("2005-03-15", "2010-06-20", "2005-04-01", "2010-07-01"),
+        ("2005-03-01", "2010-06-01", "2005-03-01", "2010-06-01"),
+        ("2005-03-02", "2005-03-31", "2005-04-01", "2005-04-01"),
+        ("2005-12-31", "2006-12-31", "2006-01-01", "2007-01-01"),
+    ],
+)
+def test_mid_month_dates_round_up(discovery, start, end, rounded_start, rounded_end):
+    day = datetime.datetime.fromisoformat
+    for search in searches(discovery):
+        exact = availability.sites_with_data(discovery, search, day(start), day(end))
+        same_answer(exact, availability.sites_with_data(discovery, search, day(rounded_start), day(rounded_end)))
+        same_answer(exact, availability.sites_with_data_sql(search, day(start), day(end)))
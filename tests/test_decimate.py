@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import decimate
+
+# Both methods promise at most n_out samples, whatever the budget and however many gaps the
+# series has, with the first and last sample among them once there is room for both.
+
+
+def series(n, missing, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.arange(n, dtype=np.int64) * 3600
+    y = np.sin(np.arange(n) / 50.0) + rng.normal(0, 0.1, n)
+    y[rng.random(n) < missing] = np.nan
+    # A few long gaps as well as the scattered missing values.
+    for start in rng.integers(0, n, size=5):
+        y[start:start + 200] = np.nan
+    return x, y
+
+
+@pytest.mark.parametrize("method", [decimate.minmax, decimate.lttb])
+@pytest.mark.parametrize("missing", [0.0, 0.01, 0.3])
+@pytest.mark.parametrize("n_out", [0, 1, 2, 3, 4, 5, 10, 101, 2000])
+def test_within_budget(method, missing, n_out):
+    x, y = series(20000, missing)
+    keep = method(x, y, n_out)
+    assert len(keep) <= n_out
+    assert np.all(np.diff(keep) > 0)
+    if n_out >= 2:
+        assert keep[0] == 0 and keep[-1] == len(y) - 1
+
+
+@pytest.mark.parametrize("method", [decimate.minmax, decimate.lttb])
+def test_gaps_are_marked(method):
+    x, y = series(20000, 0.0)
+    keep = method(x, y, 2000)
+    assert np.isnan(y[keep]).sum() > 0
+
+
+@pytest.mark.parametrize("method", [decimate.minmax, decimate.lttb])
+def test_short_series_is_kept(method):
+    x, y = series(500, 0.01)
+    assert np.array_equal(method(x, y, 500), np.arange(500))
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import erddap_cache
+
+# The cached spans decide what is read from ERDDAP and what is sliced from disk. Spans are closed,
+# like the time>= and time<= constraints they are fetched with.
+
+
+@pytest.mark.parametrize(
+    "spans, start, end, missing",
+    [
+        ([], 0, 100, [(0, 100)]),
+        ([(0, 100)], 10, 20, []),
+        ([(0, 100)], 0, 100, []),
+        ([(0, 10), (20, 30)], 5, 25, [(10, 20)]),
+        ([(20, 30)], 0, 50, [(0, 20), (30, 50)]),
+        ([(0, 10)], 10, 20, [(10, 20)]),
+        ([(10, 20)], 0, 10, [(0, 10)]),
+        ([(50, 60)], 0, 10, [(0, 10)]),
+        ([(0, 10)], 20, 30, [(20, 30)]),
+        ([(0, 10), (20, 30), (40, 50)], 0, 50, [(10, 20), (30, 40)]),
+        ([(0, 10)], 5, 5, []),
+        ([(0, 10)], 15, 15, [(15, 15)]),
+    ],
+)
+def test_missing_spans(spans, start, end, missing):
+    assert erddap_cache.missing_spans(spans, start, end) == missing
+
+
+@pytest.mark.parametrize(
+    "spans, merged",
+    [
+        ([], []),
+        ([(0, 10), (5, 20)], [(0, 20)]),
+        ([(0, 10), (10, 20)], [(0, 20)]),
+        ([(10, 20), (0, 5)], [(0, 5), (10, 20)]),
+        ([(0, 100), (10, 20)], [(0, 100)]),
+        ([(30, 40), (0, 10), (5, 35)], [(0, 40)]),
+    ],
+)
+def test_merge_spans(spans, merged):
+    assert erddap_cache.merge_spans(spans) == merged
+
+
+def covered(spans, points):
+    return np.array([any(s0 <= p <= s1 for s0, s1 in spans) for p in points])
+
+
+def test_missing_spans_fill_the_request():
+    # What was cached plus what is fetched covers every point of the request, nothing but the end
+    # points of a fetched span is already cached, and afterwards nothing is missing.
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        bounds = np.sort(rng.integers(0, 200, size=2 * int(rng.integers(0, 5))))
+        spans = erddap_cache.merge_spans([(int(a), int(b)) for a, b in bounds.reshape(-1, 2)])
+        start, end = sorted(int(v) for v in rng.integers(0, 200, size=2))
+        missing = erddap_cache.missing_spans(spans, start, end)
+        points = np.arange(start, end + 1)
+        assert covered(spans + missing, points).all()
+        for m0, m1 in missing:
+            assert not covered(spans, np.arange(m0 + 1, m1)).any()
+        assert erddap_cache.missing_spans(erddap_cache.merge_spans(spans + missing), start, end) == []
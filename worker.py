@@ -0,0 +1,9 @@
+# What the celery worker and beat processes load instead of app.py:
+#
+#   celery -A worker:celery_app worker
+#   celery -A worker:celery_app beat
+#
+# Importing plots registers the background plot callback as a celery task, under the same name
+# the web workers queue it with, and tasks has the scheduled database refresh.
+import plots
+from tasks import celery_app